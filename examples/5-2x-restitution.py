@@ -1,3 +1,9 @@
+import multiprocessing
+
+import myokit
+import numpy as np
+
+
 class Restitution(object):
     """
     Can run a restitution experiment and return the values needed to make a
@@ -37,64 +43,202 @@ class Restitution(object):
         self.set_max_step_size()
         self.set_times()
         self.set_beats()
+        self.set_continuation()
         self.set_stimulus()
         self.set_threshold()
 
         # No data yet!
         self._data = None
+        self._times = None
 
-    def _run(self):
+    def __getstate__(self):
         """
-        Runs the simulations, saves the data.
+        Called when pickling, e.g. to send this experiment to a worker process.
+
+        Variables can't be pickled, so the membrane potential is stored by
+        name.
         """
-        # Create protocol
-        e = {
-            'level': self._stim_level,
-            'start': 0,
-            'duration': self._stim_duration,
-            'period': self._clmin,
-            'multiplier': 0,
-        }
+        state = dict(self.__dict__)
+        state['_vvar'] = self._vvar.qname()
+        state['_data'] = None
+        return state
 
-        # Create simulation
-        s = myokit.Simulation(self._model)
-        s.set_max_step_size(self._max_step_size)
+    def __setstate__(self, state):
+        """
+        Called after unpickling.
+        """
+        self.__dict__.update(state)
+        self._vvar = self._model.get(self._vvar)
 
-        # Start testing
+    def _cycle_lengths(self):
+        """
+        Returns a list of the tested cycle lengths, from long to short.
+        """
+        cls = []
         i = 0
-        pcls = []
-        apds = []
         c = self._clmax
         while c >= self._clmin:
-            # Update cycle length
-            c = self._clmax - i * self._dcl
+            cls.append(c)
             i += 1
+            c = self._clmax - i * self._dcl
+        return cls
+
+    def _measure(self, s, cls):
+        """
+        Tests the cycle lengths ``cls`` in turn, using the simulation ``s``.
+
+        Returns a tuple ``(results, tpre, trun)``, where ``results`` is a list
+        with a tuple ``(apds, pre)`` for each cycle length, ``apds`` is a list
+        of the measured action potential durations and ``pre`` is the number
+        of pre-pacing beats that were run. The time spent pre-pacing and
+        running measured beats is returned as ``tpre`` and ``trun``.
+        """
+        b = myokit.tools.Benchmarker()
+        tpre = trun = 0
 
-            # Create and set new protocol
-            p = myokit.Protocol()
-            e['period'] = c
-            p.schedule(**e)
-            s.set_protocol(p)
+        results = []
+        state = self._model.initial_values(True)
 
-            # Run simulation
+        # The simulation's protocol contains a block of stimuli for every
+        # cycle length, see :meth:`_protocol`.
+        starts = self._protocol()[1]
+        for c in cls:
+            start = starts[c]
+
+            # Start from the model's initial state, so that each cycle length
+            # is tested independently, or from the final state reached at the
+            # previous cycle length if continuation is enabled. Note that pre()
+            # updates the default state, so a reset() alone would start from
+            # the last pre-paced state.
+            s.set_default_state(state)
             s.reset()
-            s.pre(c * self._pre_beats)
+
+            # Pre-pace, starting at this cycle length's block of stimuli. With
+            # a tolerance, this is done one beat at a time (pre() does not
+            # change the simulation time, so each beat starts at ``start``).
+            b.reset()
+            s.set_time(start)
+            if self._pre_tolerance is None:
+                s.pre(c * self._pre_beats)
+                pre = self._pre_beats
+            else:
+                pre = 0
+                x0 = np.array(s.state())
+                while pre < self._pre_beats:
+                    s.set_time(start)
+                    s.pre(c)
+                    pre += 1
+                    x1 = np.array(s.state())
+                    if _relative_change(x0, x1) < self._pre_tolerance:
+                        break
+                    x0 = x1
+            tpre += b.time()
+
+            # Run measured beats
+            b.reset()
+            s.set_time(start)
             d, a = s.run(
                 c * self._beats,
                 log=myokit.LOG_NONE,
-                apd_variable=self._vvar,
+                apd_variable=self._vvar.qname(),
                 apd_threshold=self._apd_threshold
             )
+            trun += b.time()
+            results.append((list(a['duration']), pre))
+
+            if self._continuation:
+                state = s.state()
+
+        return results, tpre, trun
+
+    def _run(self, workers=None):
+        """
+        Runs the simulations, saves the data.
+        """
+        b = myokit.tools.Benchmarker()
+        cls = self._cycle_lengths()
 
-            # Save apds
-            for apd in a['duration']:
+        if workers is None or workers == 1:
+            # Test every cycle length in turn, on a single simulation
+            s = self._simulation()
+            tset = b.time()
+            results, tpre, trun = self._measure(s, cls)
+        else:
+            # Divide the cycle lengths over a pool of worker processes, each
+            # with its own simulation. With continuation, each worker gets a
+            # contiguous block of cycle lengths, otherwise each cycle length
+            # is a separate task. The results are returned in order.
+            if self._continuation:
+                blocks = np.array_split(cls, min(workers, len(cls)))
+                blocks = [list(block) for block in blocks]
+            else:
+                blocks = [[c] for c in cls]
+            with multiprocessing.Pool(
+                    workers, _worker_init, (self, )) as pool:
+                blocks = pool.map(_worker_measure, blocks, chunksize=1)
+            results = []
+            tset = tpre = trun = 0
+            for result, t1, t2, t3 in blocks:
+                results.extend(result)
+                tset += t1
+                tpre += t2
+                trun += t3
+
+        # Save apds
+        pcls = []
+        apds = []
+        pres = []
+        for c, (result, pre) in zip(cls, results):
+            for apd in result:
                 pcls.append(c)
                 apds.append(apd)
+                pres.append(pre)
 
         # Store data
-        self._data = pcls, apds
+        self._data = pcls, apds, pres
+        self._times = {
+            'setup': tset,
+            'pre': tpre,
+            'run': trun,
+            'total': b.time(),
+        }
+
+    def _protocol(self):
+        """
+        Creates a single protocol for all cycle lengths, and returns a tuple
+        ``(protocol, starts)``, where ``starts`` maps each cycle length to the
+        time its block of stimuli starts.
+
+        Each block contains enough beats for pre-pacing and for the measured
+        beats, which are both started at the beginning of the block. This way,
+        the protocol is created and set only once, when the simulation is
+        created.
+        """
+        n = max(self._pre_beats, self._beats)
+        p = myokit.Protocol()
+        starts = {}
+        t = 0
+        for c in self._cycle_lengths():
+            p.schedule(
+                level=self._stim_level,
+                start=t,
+                duration=self._stim_duration,
+                period=c,
+                multiplier=n,
+            )
+            starts[c] = t
+            t += n * c
+        return p, starts
+
+    def _simulation(self):
+        """
+        Creates and returns a simulation for this experiment.
+        """
+        s = myokit.Simulation(self._model, self._protocol()[0])
+        s.set_max_step_size(self._max_step_size)
+        return s
 
-    def run(self):
+    def run(self, workers=None):
         """
         Returns a :class:`DataLog` containing the tested cycle lengths as
         ``cl`` and the measured action potential durations as ``apd``. The
@@ -102,19 +246,62 @@ class Restitution(object):
 
         Each cycle length is repeated ``beats`` number of times, where
         ``beats`` is the number of beats specified in the constructor.
+
+        The number of pre-pacing beats run before each measurement is given as
+        ``pre``. This is only different from the value set with
+        :meth:`set_beats` if a steady-state tolerance was set.
+
+        The cycle lengths are independent, and can be tested in parallel by
+        setting ``workers`` to the number of processes to use. Each worker
+        process creates its own simulation, which is compiled once and then
+        reused for all cycle lengths assigned to that worker. The results are
+        the same as for a serial run, and are returned in the same order.
+
+        If continuation is enabled (see :meth:`set_continuation`), each worker
+        is given a contiguous block of cycle lengths instead, and only the
+        first cycle length in each block starts from the initial state.
         """
+        if workers is not None:
+            workers = int(workers)
+            if workers < 1:
+                raise ValueError(
+                    'The number of workers must be an integer greater than'
+                    ' zero.')
+
         # Run
         if self._data is None:
-            self._run()
+            self._run(workers)
         # Get data
-        cl, apd = self._data
+        cl, apd, pre = self._data
         d = myokit.DataLog()
         d['cl'] = list(cl)
         d['apd'] = list(apd)
-        d['di'] = list(np.array(cl, copy=False) - np.array(apd, copy=False))
+        d['di'] = list(np.asarray(cl) - np.asarray(apd))
+        d['pre'] = list(pre)
         return d
 
-    def set_beats(self, beats=2, pre=50):
+    def times(self):
+        """
+        Returns a dict with the time (in seconds) spent in the last run of this
+        experiment, or ``None`` if no run has been performed yet.
+
+        The dict contains the following entries:
+
+        ``setup``
+            The time spent creating (and compiling) simulations.
+        ``pre``
+            The time spent pre-pacing.
+        ``run``
+            The time spent running the beats during which APDs are measured.
+        ``total``
+            The total wall-clock time of the run.
+
+        For parallel runs, ``setup``, ``pre``, and ``run`` are summed over all
+        worker processes, and so may add up to more than ``total``.
+        """
+        return None if self._data is None else dict(self._times)
+
+    def set_beats(self, beats=2, pre=50, tolerance=None):
         """
         Sets the number of beats each cycle length is tested for.
 
@@ -123,6 +310,13 @@ class Restitution(object):
         ``pre``
             The number of pre-pacing beats done at each cycle length before the
             measurement.
+        ``tolerance``
+            An optional tolerance for adaptive pre-pacing. If set, pre-pacing
+            is done one beat at a time, and stops as soon as the relative
+            change in every state variable from one beat to the next is less
+            than ``tolerance``. In this case ``pre`` sets the maximum number of
+            pre-pacing beats.
+
         """
         beats = int(beats)
         pre = int(pre)
@@ -132,8 +326,27 @@ class Restitution(object):
         if pre < 0:
             raise ValueError(
                 'The number of pre-pacing beats must be a positive integer.')
+        if tolerance is not None:
+            tolerance = float(tolerance)
+            if tolerance <= 0:
+                raise ValueError('The tolerance must be greater than zero.')
         self._beats = beats
         self._pre_beats = pre
+        self._pre_tolerance = tolerance
+        self._data = None
+
+    def set_continuation(self, continuation=False):
+        """
+        Enables or disables continuation.
+
+        By default, each cycle length is pre-paced starting from the model's
+        initial state. With ``continuation=True``, each cycle length starts
+        from the final state reached at the previous (slightly longer) cycle
+        length instead. As this state is usually much closer to the new steady
+        state, this works well with an adaptive pre-pacing tolerance (see
+        :meth:`set_beats`).
+        """
+        self._continuation = bool(continuation)
         self._data = None
 
     def set_max_step_size(self, dtmax=None):
@@ -204,3 +417,38 @@ class Restitution(object):
         self._dcl = dcl
         self._data = None
 
+
+def _relative_change(x0, x1):
+    """
+    Returns the largest relative change between two states ``x0`` and ``x1``.
+    """
+    d = np.abs(x1 - x0)
+    x = np.maximum(np.abs(x0), np.abs(x1))
+    i = x > 0
+    return np.max(d[i] / x[i]) if np.any(i) else 0
+
+
+# Experiment and simulation used by the current worker process
+_worker = None
+
+
+def _worker_init(experiment):
+    """
+    Initialises a worker process for a parallel :class:`Restitution` run.
+    """
+    global _worker
+    b = myokit.tools.Benchmarker()
+    _worker = [experiment, experiment._simulation(), b.time()]
+
+
+def _worker_measure(cls):
+    """
+    Tests a list of cycle lengths in a worker process.
+
+    Returns a tuple ``(results, tset, tpre, trun)``, where ``tset`` is the
+    time spent setting up this worker (only reported with its first task).
+    """
+    experiment, s, tset = _worker
+    _worker[2] = 0
+    results, tpre, trun = experiment._measure(s, cls)
+    return results, tset, tpre, trun
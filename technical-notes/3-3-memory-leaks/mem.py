@@ -6,52 +6,77 @@ import gc
 import os
 import resource
 import sys
+import time
 import tracemalloc
 
 import myokit
 import psutil
-import pympler.tracker
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 
-def test(command, repeats, use_pympler=False, init_gc=True, force_gc=False):
-
-    print(f'Testing with {command}, {repeats} repeats')
-    print('Initial GC' if init_gc else 'No initial GC')
-    print('Continuous GC' if force_gc else 'Automatic GC')
-
+def measure(command, repeats, use_pympler=False, init_gc=True,
+            force_gc=False, interval=1, census=1, capacity=None):
+    """
+    Runs ``command()`` ``repeats`` times, and returns a dict with arrays of
+    memory statistics.
+
+    Cheap statistics (VMS, RSS, maximum RSS, and traced memory) are sampled
+    after every ``interval`` iterations, and returned along with the iteration
+    numbers as ``it``. Expensive statistics (the number of objects tracked by
+    the garbage collector, which takes a walk over the whole heap, and the
+    number of collections) are sampled every ``census`` iterations, and
+    returned along with the iteration numbers as ``cit``.
+
+    All samples are written into buffers that are allocated before the run
+    starts, so that measuring does not affect memory use. Each buffer holds up
+    to ``capacity`` samples (default: enough for the whole run), after which
+    the oldest samples are overwritten.
+
+    The returned dict also contains the time spent running ``command`` as
+    ``time``, and the time spent sampling as a percentage of the total time as
+    ``overhead``.
+    """
     # Get and show pid
     pid = os.getpid()
     print(f'PID: {pid}')
 
-    # Get command
-    print('Loading test case')
-    name = command
-    command = case(name)
-
-    # Create lists
-    ind = np.arange(1, 1 + repeats)
-    vms = np.zeros(repeats)
-    rss = np.zeros(repeats)
-    mxr = np.zeros(repeats)
-    nob = np.zeros(repeats)
-    nc1 = np.zeros(repeats)
-    nc2 = np.zeros(repeats)
-    nc3 = np.zeros(repeats)
-    tm1 = np.zeros(repeats)
-    tm2 = np.zeros(repeats)
+    # Check intervals
+    interval, census = int(interval), int(census)
+    if interval < 1 or census < 1:
+        raise ValueError('Sampling intervals must be at least 1.')
+
+    # Create buffers. Arrays created with np.zeros only take up memory when
+    # they are written to, which would show up as growth in the RSS, so
+    # np.full is used to write to every page before the first sample.
+    n1 = capacity or (repeats - 1) // interval + 1
+    n2 = capacity or (repeats - 1) // census + 1
+    it = np.full(n1, 0, dtype=int)
+    vms = np.full(n1, 0.0)
+    rss = np.full(n1, 0.0)
+    mxr = np.full(n1, 0.0)
+    tm1 = np.full(n1, 0.0)
+    tm2 = np.full(n1, 0.0)
+    cit = np.full(n2, 0, dtype=int)
+    nob = np.full(n2, 0.0)
+    nc1 = np.full(n2, 0.0)
+    nc2 = np.full(n2, 0.0)
+    nc3 = np.full(n2, 0.0)
+    k1 = k2 = 0
 
     # Set up, fill caches
     print('Getting process in psutil')
     p = psutil.Process(pid)
-    nob[0] = len(gc.get_objects())
+    p.memory_info()
+    len(gc.get_objects())
     stats = gc.get_stats()
+    clock = time.perf_counter
+    clock()
 
     # Flush pympler stuff
     if use_pympler:
         print('Loading pympler tracker')
+        import pympler.tracker
         tracker = pympler.tracker.SummaryTracker()
         stdout = sys.stdout
         sys.stdout = None
@@ -66,43 +91,93 @@ def test(command, repeats, use_pympler=False, init_gc=True, force_gc=False):
 
     # Start tracemalloc
     tracemalloc.start()
-    mac = tracemalloc.get_traced_memory()
-    tm1[0] = mac[0] #- tracemalloc.get_tracemalloc_memory()
-    tm2[0] = mac[1]
 
     # Run
     print('Running')
-    for i in range(repeats):
-        if use_pympler:
-            tracker.diff()
-        command()
-        if force_gc:
-            gc.collect()
-
-        if use_pympler:
-            print()
-            tracker.print_diff()
-        elif not i % 100:
-            print('.', end='')
-            sys.stdout.flush()
-
-        mem = p.memory_info()
-        vms[i] = mem.vms
-        rss[i] = mem.rss
-        mxr[i] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-        nob[i] = len(gc.get_objects())
-        stats = gc.get_stats()
-        nc1[i] = stats[0]['collections']
-        nc2[i] = stats[1]['collections']
-        nc3[i] = stats[2]['collections']
-        mac = tracemalloc.get_traced_memory()
-        tm1[i] = mac[0] #- tracemalloc.get_tracemalloc_memory()
-        tm2[i] = mac[1]
+    t_run = t_probe = 0
+    try:
+        for i in range(repeats):
+            t0 = clock()
+            if use_pympler:
+                tracker.diff()
+            command()
+            if force_gc:
+                gc.collect()
+            t1 = clock()
+
+            if use_pympler:
+                print()
+                tracker.print_diff()
+            elif not i % 100:
+                print('.', end='')
+                sys.stdout.flush()
+
+            if i % interval == 0:
+                j = k1 % n1
+                it[j] = i
+                mem = p.memory_info()
+                vms[j] = mem.vms
+                rss[j] = mem.rss
+                mxr[j] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                mac = tracemalloc.get_traced_memory()
+                tm1[j] = mac[0] #- tracemalloc.get_tracemalloc_memory()
+                tm2[j] = mac[1]
+                k1 += 1
+
+            if i % census == 0:
+                j = k2 % n2
+                cit[j] = i
+                nob[j] = len(gc.get_objects())
+                stats = gc.get_stats()
+                nc1[j] = stats[0]['collections']
+                nc2[j] = stats[1]['collections']
+                nc3[j] = stats[2]['collections']
+                k2 += 1
+
+            t2 = clock()
+            t_run += t1 - t0
+            t_probe += t2 - t1
+    finally:
+        tracemalloc.stop()
 
     if not use_pympler:
         print('')
 
+    # Put samples in chronological order
+    def unroll(x, k):
+        return np.roll(x, -k)[-k:] if k <= len(x) else np.roll(x, -k)
+
+    d = dict(vms=vms, rss=rss, mxr=mxr, tm1=tm1, tm2=tm2, it=it)
+    d = {key: unroll(x, k1) for key, x in d.items()}
+    e = dict(nob=nob, nc1=nc1, nc2=nc2, nc3=nc3, cit=cit)
+    d.update({key: unroll(x, k2) for key, x in e.items()})
+    d['time'] = t_run
+    d['overhead'] = 100 * t_probe / (t_run + t_probe)
+    return d
+
+
+def test(command, repeats, use_pympler=False, init_gc=True, force_gc=False,
+         interval=1, census=1):
+
+    print(f'Testing with {command}, {repeats} repeats')
+    print('Initial GC' if init_gc else 'No initial GC')
+    print('Continuous GC' if force_gc else 'Automatic GC')
+
+    # Get command
+    print('Loading test case')
+    name = command
+    command = case(name)
+
+    # Run
+    d = measure(
+        command, repeats, use_pympler, init_gc, force_gc, interval, census)
+    print(f'Measurement overhead: {d["overhead"]:.1f}%')
+    ind, cind = 1 + d['it'], 1 + d['cit']
+    vms, rss, mxr, nob = d['vms'], d['rss'], d['mxr'], d['nob']
+    nc1, nc2, nc3, tm1, tm2 = d['nc1'], d['nc2'], d['nc3'], d['tm1'], d['tm2']
+
     # Figure
+    import matplotlib.pyplot as plt
     ds = 'steps-pre'
     fig = plt.figure(figsize=(8, 10))
     fig.subplots_adjust(0.1, 0.04, 0.99, 0.99, wspace=0.4, hspace=0.5)
@@ -131,21 +206,21 @@ def test(command, repeats, use_pympler=False, init_gc=True, force_gc=False):
 
     ax = fig.add_subplot(grid[3, 0])
     ax.set_ylabel('GC objects')
-    ax.plot(ind, nob, ds=ds)
+    ax.plot(cind, nob, ds=ds)
     ax = fig.add_subplot(grid[3, 1])
     ax.set_ylabel('$\Delta$ GC obj.')
-    ax.plot(ind, nob, ds=ds)
+    ax.plot(cind, nob, ds=ds)
 
     ax = fig.add_subplot(grid[4, 0])
     ax.set_ylabel('GC collects')
-    ax.plot(ind, nc1, ds=ds)
-    ax.plot(ind, nc2, ds=ds)
-    ax.plot(ind, nc3, ds=ds)
+    ax.plot(cind, nc1, ds=ds)
+    ax.plot(cind, nc2, ds=ds)
+    ax.plot(cind, nc3, ds=ds)
     ax = fig.add_subplot(grid[4, 1])
     ax.set_ylabel('$\Delta$ GC coll.')
-    ax.plot(ind, nc1 - nc1[0], ds=ds)
-    ax.plot(ind, nc2 - nc2[0], ds=ds)
-    ax.plot(ind, nc3 - nc3[0], ds=ds)
+    ax.plot(cind, nc1 - nc1[0], ds=ds)
+    ax.plot(cind, nc2 - nc2[0], ds=ds)
+    ax.plot(cind, nc3 - nc3[0], ds=ds)
 
     ax = fig.add_subplot(grid[5, 0])
     ax.set_ylabel('Tracemalloc peak (kib)')
@@ -164,6 +239,93 @@ def test(command, repeats, use_pympler=False, init_gc=True, force_gc=False):
     plt.show()
 
 
+def slope(x, y, warmup=0.2):
+    """
+    Fits a straight line to the samples ``y`` taken at iterations ``x``,
+    ignoring the first fraction ``warmup`` of the points (while caches fill up
+    etc.), and returns a tuple ``(slope, error)`` with the growth per iteration
+    and its standard error.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    i = int(len(y) * warmup)
+    x, y = x[i:], y[i:]
+    if len(y) < 3:
+        raise ValueError('Not enough points to fit a slope.')
+    x = x - np.mean(x)
+    b = np.sum(x * (y - np.mean(y))) / np.sum(x * x)
+    r = y - np.mean(y) - b * x
+    e = np.sqrt(np.sum(r * r) / (len(y) - 2) / np.sum(x * x))
+    return b, e
+
+
+def suite(names=None, repeats=5000, warmup=0.2, budget=4, objects=0.01,
+          interval=1, census=100):
+    """
+    Runs each of the test cases in ``names`` (or all cases if not given) for
+    ``repeats`` iterations, and checks the growth in RSS, in memory traced by
+    ``tracemalloc``, and in the number of objects tracked by ``gc``.
+
+    A case fails if RSS or traced memory grow by more than ``budget`` bytes
+    per iteration, or if the number of GC-tracked objects grows by more than
+    ``objects`` per iteration. Growth is estimated by fitting a straight line
+    to all but the first fraction ``warmup`` of the iterations.
+
+    Memory use is sampled every ``interval`` iterations, while the number of
+    GC-tracked objects is counted every ``census`` iterations (see
+    :meth:`measure`).
+
+    Returns ``True`` if all cases passed.
+    """
+    if names is None:
+        names = cases
+    limits = {'rss': budget, 'tm1': budget, 'nob': objects}
+    labels = {'rss': 'RSS (B/it)', 'tm1': 'traced (B/it)', 'nob': 'GC obj./it'}
+
+    results = []
+    for name in names:
+        print(f'Testing {name}, {repeats} repeats')
+        command = case(name)
+        d = measure(command, repeats, interval=interval, census=census)
+        del command
+        gc.collect()
+
+        fits = {k: slope(d['cit' if k == 'nob' else 'it'], d[k], warmup)
+                for k in limits}
+        failed = [k for k, (b, e) in fits.items() if b > limits[k]]
+        results.append((name, fits, failed, d['overhead']))
+
+    # Show table of results
+    print()
+    print(f'Budget: {budget} bytes and {objects} GC objects per iteration')
+    print(' ' * 14 + ''.join(f'{x:>22}' for x in labels.values())
+          + '  overhead')
+    for name, fits, failed, overhead in results:
+        line = f'{name:<14}'
+        for k in labels:
+            line += f'{fits[k][0]:>12.3g} ± {fits[k][1]:<7.2g}'
+        line += f'{overhead:>9.1f}%'
+        if failed:
+            line += ' FAIL (' + ', '.join(labels[k] for k in failed) + ')'
+        else:
+            line += ' ok'
+        print(line)
+
+    return not any(failed for _, _, failed, _ in results)
+
+
+# Names of all test cases
+cases = [
+    'plain',
+    'sens',
+    'realtime',
+    'apd',
+    'log_times',
+    'log_times_np',
+    'fixed_form',
+]
+
+
 def case(name='plain'):
     # Return a simulation method
     m, p, _ = myokit.load('example')
@@ -242,5 +404,46 @@ def case(name='plain'):
     return c
 
 
-test('plain', 500, init_gc=True, force_gc=False)
-
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Test myokit simulations for memory leaks.')
+    parser.add_argument(
+        'cases', nargs='*', metavar='case',
+        help='The cases to test (default: all). Options: ' + ', '.join(cases))
+    parser.add_argument(
+        '-n', '--repeats', type=int, default=5000,
+        help='The number of iterations per case.')
+    parser.add_argument(
+        '--warmup', type=float, default=0.2,
+        help='The fraction of iterations to ignore when fitting slopes.')
+    parser.add_argument(
+        '--budget', type=float, default=4,
+        help='The allowed growth in RSS and traced memory, in bytes per'
+             ' iteration.')
+    parser.add_argument(
+        '--objects', type=float, default=0.01,
+        help='The allowed growth in GC-tracked objects per iteration.')
+    parser.add_argument(
+        '--interval', type=int, default=1,
+        help='Measure memory use every INTERVAL iterations.')
+    parser.add_argument(
+        '--census', type=int, default=100,
+        help='Count GC-tracked objects every CENSUS iterations.')
+    parser.add_argument(
+        '--plot', action='store_true',
+        help='Plot the statistics for a single case, instead of testing.')
+    args = parser.parse_args()
+    for name in args.cases:
+        if name not in cases:
+            parser.error(f'Unknown case: {name}')
+
+    if args.plot:
+        if len(args.cases) != 1:
+            parser.error('Exactly one case must be given with --plot.')
+        test(args.cases[0], args.repeats, init_gc=True, force_gc=False,
+             interval=args.interval, census=args.census)
+    elif not suite(args.cases or None, args.repeats, args.warmup, args.budget,
+                   args.objects, args.interval, args.census):
+        sys.exit(1)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#
+# Monitors the memory use of a process from a separate watcher process, by
+# reading /proc/<pid>/smaps_rollup (or /proc/<pid>/statm) at a fixed rate.
+#
+# Linux only.
+#
+import argparse
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import time
+
+import numpy as np
+
+
+# Format of a single sample: time since the start of monitoring (s), the
+# iteration reached by the workload (-1 if unknown), and RSS, PSS, and
+# anonymous memory (in bytes). PSS is zero if only statm was available.
+_record = struct.Struct('<dqqqq')
+dtype = np.dtype([
+    ('t', '<f8'),
+    ('it', '<i8'),
+    ('rss', '<i8'),
+    ('pss', '<i8'),
+    ('anon', '<i8'),
+])
+
+# Regex to find fields in smaps_rollup
+_rollup_regex = re.compile(rb'^(Rss|Pss|Anonymous):\s+(\d+) kB', re.MULTILINE)
+
+
+def watch(pid, path, rate=100, counter=None, stop=None, statm=False):
+    """
+    Samples the memory use of process ``pid`` ``rate`` times per second, and
+    writes the samples to a binary file at ``path`` until the process exits or
+    until ``stop.value`` is set to a non-zero value.
+
+    If a shared integer ``counter`` is given (e.g. a
+    ``multiprocessing.RawValue``), its value is stored with every sample, so
+    that samples can be aligned with the iterations of the workload.
+
+    By default, RSS, PSS, and anonymous memory are read from
+    ``/proc/<pid>/smaps_rollup``. This is slightly more expensive for the
+    kernel, so with ``statm=True`` only ``/proc/<pid>/statm`` is read instead,
+    and anonymous memory is estimated as resident minus shared memory.
+    """
+    page = os.sysconf('SC_PAGE_SIZE')
+    if not statm and not os.path.exists(f'/proc/{pid}/smaps_rollup'):
+        statm = True
+    fd = os.open(f'/proc/{pid}/{"statm" if statm else "smaps_rollup"}',
+                 os.O_RDONLY)
+
+    dt = 1 / rate
+    t0 = time.perf_counter()
+    n = 0
+    try:
+        with open(path, 'wb') as f:
+            while stop is None or not stop.value:
+                # Read memory use
+                try:
+                    data = os.pread(fd, 4096, 0)
+                except (OSError, ProcessLookupError):
+                    break
+                if not data:
+                    break
+                if statm:
+                    fields = data.split()
+                    rss = int(fields[1]) * page
+                    pss = 0
+                    anon = (int(fields[1]) - int(fields[2])) * page
+                else:
+                    fields = dict(_rollup_regex.findall(data))
+                    rss = int(fields[b'Rss']) * 1024
+                    pss = int(fields[b'Pss']) * 1024
+                    anon = int(fields[b'Anonymous']) * 1024
+
+                # Write sample
+                t = time.perf_counter() - t0
+                it = -1 if counter is None else counter.value
+                f.write(_record.pack(t, it, rss, pss, anon))
+                n += 1
+
+                # Wait until next sample is due
+                time.sleep(max(0, n * dt - (time.perf_counter() - t0)))
+    finally:
+        os.close(fd)
+
+
+def load(path):
+    """
+    Loads samples written by :meth:`watch`, and returns them as a numpy record
+    array with fields ``t``, ``it``, ``rss``, ``pss``, and ``anon``.
+    """
+    return np.fromfile(path, dtype=dtype)
+
+
+def run(name, repeats, path, rate=100, statm=False):
+    """
+    Runs the test case ``name`` from ``mem.py`` for ``repeats`` iterations,
+    while a separate watcher process writes samples to ``path``.
+
+    The workload only increments a counter in shared memory after each
+    iteration, and does no measuring itself.
+
+    The watcher process is started with ``spawn`` rather than ``fork``, so that
+    it doesn't share any memory with the workload (which would affect the
+    workload's PSS).
+    """
+    import mem
+
+    ctx = multiprocessing.get_context('spawn')
+    counter = ctx.RawValue('q', -1)
+    stop = ctx.RawValue('b', 0)
+    watcher = ctx.Process(
+        target=watch, args=(os.getpid(), path, rate, counter, stop, statm))
+    watcher.start()
+
+    print(f'Testing {name}, {repeats} repeats')
+    command = mem.case(name)
+    b = time.perf_counter()
+    for i in range(repeats):
+        command()
+        counter.value = i
+    b = time.perf_counter() - b
+
+    stop.value = 1
+    watcher.join()
+    print(f'Ran {repeats} iterations in {b:.1f} seconds')
+
+
+def report(path, warmup=0.2):
+    """
+    Shows the growth per iteration of RSS, PSS, and anonymous memory, using
+    the samples in ``path``.
+    """
+    import mem
+
+    d = load(path)
+    print(f'Loaded {len(d)} samples from {path}')
+    d = d[d['it'] >= 0]
+    if len(d) < 3:
+        print('Not enough samples taken during iterations.')
+        return
+    for key in ['rss', 'pss', 'anon']:
+        b, e = mem.slope(d['it'], d[key], warmup)
+        print(f'{key.upper():<5} {b:>12.3g} ± {e:<7.2g} bytes per iteration')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Monitor memory use from a separate process.')
+    parser.add_argument(
+        'case', nargs='?', default='plain',
+        help='The test case from mem.py to run.')
+    parser.add_argument(
+        '-n', '--repeats', type=int, default=5000,
+        help='The number of iterations to run.')
+    parser.add_argument(
+        '-o', '--output', metavar='PATH',
+        help='The file to write samples to (default: <case>-<repeats>.bin).')
+    parser.add_argument(
+        '--pid', type=int,
+        help='Monitor an existing process, instead of running a test case.')
+    parser.add_argument(
+        '--rate', type=float, default=100,
+        help='The number of samples per second.')
+    parser.add_argument(
+        '--statm', action='store_true',
+        help='Read /proc/<pid>/statm instead of smaps_rollup.')
+    parser.add_argument(
+        '--warmup', type=float, default=0.2,
+        help='The fraction of samples to ignore when fitting slopes.')
+    args = parser.parse_args()
+    if not sys.platform.startswith('linux'):
+        parser.error('This script requires the Linux /proc file system.')
+
+    if args.pid:
+        path = args.output or f'{args.pid}.bin'
+        print(f'Monitoring process {args.pid}, writing to {path}')
+        try:
+            watch(args.pid, path, args.rate, statm=args.statm)
+        except KeyboardInterrupt:
+            pass
+        print(f'Written {len(load(path))} samples')
+    else:
+        path = args.output or f'{args.case}-{args.repeats}.bin'
+        run(args.case, args.repeats, path, args.rate, args.statm)
+        report(path, args.warmup)
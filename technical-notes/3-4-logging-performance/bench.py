@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+#
+# Benchmarks the cost of different logging modes in Simulation.run().
+#
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import sys
+import tracemalloc
+
+import myokit
+import numpy as np
+
+
+# Models to test, relative to this directory
+models = {
+    'example': 'example',
+    'grandi-2011': '../../examples/models/c/grandi-2011.mmt',
+}
+
+
+def modes(model, duration):
+    """
+    Returns a dict mapping the names of the logging modes to test onto dicts
+    of keyword arguments for :meth:`myokit.Simulation.run`.
+    """
+    # An explicit list: time, membrane potential, and the first few states
+    time = model.time().qname()
+    names = [time]
+    v = model.label('membrane_potential')
+    if v is not None:
+        names.append(v.qname())
+    for x in model.states():
+        if len(names) == 4:
+            break
+        if x.qname() not in names:
+            names.append(x.qname())
+
+    return {
+        'all': {},
+        'state': {'log': myokit.LOG_STATE},
+        'inter': {'log': myokit.LOG_INTER},
+        'bound': {'log': myokit.LOG_BOUND},
+        'state+bound': {'log': myokit.LOG_STATE + myokit.LOG_BOUND},
+        'inter+bound': {'log': myokit.LOG_INTER + myokit.LOG_BOUND},
+        'list-4': {'log': names},
+        'none': {'log': []},
+        'interval': {'log_interval': 0.1},
+        'times': {'log_times': np.arange(0, duration, 0.1)},
+    }
+
+
+def confidence(x, level=0.95, samples=2000):
+    """
+    Returns a bootstrap confidence interval ``(lower, upper)`` for the mean of
+    ``x``.
+    """
+    x = np.asarray(x)
+    rng = np.random.default_rng(1)
+    means = np.mean(rng.choice(x, (samples, len(x))), axis=1)
+    a = 100 * (1 - level) / 2
+    return tuple(np.percentile(means, [a, 100 - a]))
+
+
+def benchmark(name, path, duration=1000, repeats=10, only=None):
+    """
+    Benchmarks the logging modes (or only the modes in ``only``) for the model
+    at ``path``, and returns a list of results.
+
+    Each mode is run ``repeats`` times to measure throughput, followed by an
+    untimed run in which the peak memory allocated by Python (which includes
+    the logged data) is measured with ``tracemalloc``.
+    """
+    m, p, _ = myokit.load(path)
+    s = myokit.Simulation(m, p)
+    b = myokit.tools.Benchmarker()
+
+    results = []
+    for mode, kwargs in modes(m, duration).items():
+        if only and mode not in only:
+            continue
+
+        # Warm up
+        s.reset()
+        s.run(duration, **kwargs)
+        steps = s.last_number_of_steps()
+
+        # Timed runs
+        times = []
+        for i in range(repeats):
+            s.reset()
+            gc.collect()
+            b.reset()
+            d = s.run(duration, **kwargs)
+            times.append(b.time())
+        logged = 8 * sum(len(x) for x in d.values())
+        del d
+
+        # Peak memory
+        s.reset()
+        gc.collect()
+        tracemalloc.start()
+        d = s.run(duration, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del d
+
+        times = np.array(times)
+        lo, hi = confidence(steps / times)
+        results.append({
+            'model': name,
+            'mode': mode,
+            'duration': duration,
+            'repeats': repeats,
+            'steps': steps,
+            'bytes': logged,
+            'time': list(times),
+            'steps_per_s': float(np.mean(steps / times)),
+            'steps_per_s_ci': [float(lo), float(hi)],
+            'bytes_per_s': float(np.mean(logged / times)),
+            'peak': peak,
+        })
+        show(results[-1:], header=len(results) == 1)
+    return results
+
+
+def show(results, header=True):
+    """
+    Prints a table of benchmark results.
+    """
+    if header:
+        print(f'{"model":<14}{"mode":<13}{"steps/s":>10}{"95% CI":>22}'
+              f'{"MB/s":>9}{"peak MB":>9}')
+    for r in results:
+        lo, hi = r['steps_per_s_ci']
+        print(f'{r["model"]:<14}{r["mode"]:<13}{r["steps_per_s"]:>10.3g}'
+              f'{f"{lo:.3g} - {hi:.3g}":>22}'
+              f'{r["bytes_per_s"] / 1e6:>9.3g}{r["peak"] / 1e6:>9.3g}')
+
+
+def store(results, path):
+    """
+    Appends a run with the given ``results`` to the JSON file at ``path``,
+    along with the myokit and python versions used.
+    """
+    runs = []
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            runs = json.load(f)
+    runs.append({
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'myokit': myokit.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    })
+    with open(path, 'w') as f:
+        json.dump(runs, f, indent=1)
+
+
+def history(path):
+    """
+    Shows the throughput for each model and mode in every run stored at
+    ``path``.
+    """
+    with open(path, 'r') as f:
+        runs = json.load(f)
+    for run in runs:
+        print(f'{run["date"]}, myokit {run["myokit"]},'
+              f' python {run["python"]}, {run["platform"]}')
+        show(run['results'])
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the logging modes of myokit simulations.')
+    parser.add_argument(
+        'modes', nargs='*', metavar='mode',
+        help='The logging modes to test (default: all).')
+    parser.add_argument(
+        '-m', '--model', action='append', choices=list(models),
+        help='The models to test (default: all).')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=1000,
+        help='The simulated time per run (ms).')
+    parser.add_argument(
+        '-n', '--repeats', type=int, default=10,
+        help='The number of timed runs per mode.')
+    parser.add_argument(
+        '-o', '--output', default='results.json',
+        help='The JSON file to append results to.')
+    parser.add_argument(
+        '--history', action='store_true',
+        help='Show the results stored in the output file, and exit.')
+    args = parser.parse_args()
+
+    if args.history:
+        history(args.output)
+        sys.exit(0)
+
+    results = []
+    root = os.path.dirname(os.path.abspath(__file__))
+    for name in args.model or list(models):
+        path = models[name]
+        if path != name:
+            path = os.path.join(root, path)
+            if not os.path.isfile(path):
+                print(f'Skipping {name}: model not found at {path}')
+                continue
+        results.extend(
+            benchmark(name, path, args.duration, args.repeats, args.modes))
+        print()
+
+    if results:
+        store(results, args.output)
+        print(f'Results appended to {args.output}')
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+# Reads and writes DataLogs in CSV format, using numpy to process large chunks
+# of data at once.
+#
+import csv
+import io
+import os
+import warnings
+
+import myokit
+import numpy as np
+
+
+def load_csv(filename, keys=None, precision=myokit.DOUBLE_PRECISION,
+             delimiter=',', time=None, chunk_size=2**24):
+    """
+    Loads a CSV file with a header, as written by
+    :meth:`myokit.DataLog.save_csv`, and returns a :class:`myokit.DataLog`.
+
+    ``keys``
+        An optional list of the columns to load. Other columns are skipped by
+        the parser, and are never converted to numbers.
+    ``precision``
+        The precision to store the data in, either
+        ``myokit.DOUBLE_PRECISION`` or ``myokit.SINGLE_PRECISION``.
+    ``delimiter``
+        The character used to separate columns.
+    ``time``
+        An optional key to set as the log's time key.
+    ``chunk_size``
+        The number of bytes to read and parse at once.
+
+    The file is read in chunks, each of which is parsed by numpy's (compiled)
+    ``loadtxt`` method, and copied into numpy arrays that grow as needed. The
+    returned log contains numpy arrays.
+    """
+    dtype = np.float64 if precision == myokit.DOUBLE_PRECISION else np.float32
+    filename = os.path.expanduser(filename)
+    size = os.path.getsize(filename)
+
+    with open(filename, 'rb') as f:
+        # Read header
+        header = f.readline().decode('utf8')
+        header = next(csv.reader(
+            [header], delimiter=delimiter, skipinitialspace=True))
+        header = [x.strip() for x in header]
+        if keys is None:
+            keys = header
+        else:
+            keys = list(keys)
+            for key in keys:
+                if key not in header:
+                    raise ValueError(f'Column not found: {key}')
+        if time is not None and time not in keys:
+            raise ValueError(f'Time key {time} not in selected columns.')
+        cols = [header.index(key) for key in keys]
+
+        # Parse data in chunks
+        buffers = None
+        n = 0
+        rest = b''
+        eof = False
+        while not eof:
+            # Read complete lines
+            chunk = f.read(chunk_size)
+            if chunk:
+                chunk = rest + chunk
+                i = chunk.rfind(b'\n') + 1
+                chunk, rest = chunk[:i], chunk[i:]
+            else:
+                chunk, rest, eof = rest, b'', True
+            if not chunk.strip():
+                continue
+
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                data = np.loadtxt(
+                    io.BytesIO(chunk), dtype=dtype, delimiter=delimiter,
+                    usecols=cols, ndmin=2, comments='#')
+            m = len(data)
+
+            # Allocate or grow buffers, based on the number of bytes per row
+            # seen so far.
+            if buffers is None:
+                estimate = int(1.05 * size / max(1, len(chunk) / max(1, m)))
+                buffers = np.empty((len(cols), max(m, estimate)), dtype=dtype)
+            elif n + m > buffers.shape[1]:
+                grown = np.empty(
+                    (len(cols), max(n + m, int(buffers.shape[1] * 1.5))),
+                    dtype=dtype)
+                grown[:, :n] = buffers[:, :n]
+                buffers = grown
+            buffers[:, n:n + m] = data.T
+            n += m
+
+    # Create log
+    d = myokit.DataLog()
+    for i, key in enumerate(keys):
+        d[key] = np.zeros(0, dtype) if buffers is None else buffers[i, :n]
+    if time is not None:
+        d.set_time_key(time)
+    return d
+
+
+def save_csv(log, filename, precision=myokit.DOUBLE_PRECISION, order=None,
+             delimiter=',', header=True, chunk_size=2**16):
+    """
+    Writes a :class:`myokit.DataLog` to a CSV file, in the same format as
+    :meth:`myokit.DataLog.save_csv`.
+
+    The data is written in chunks of ``chunk_size`` rows, each of which is
+    formatted with a single string formatting operation.
+    """
+    log.validate()
+    if precision == myokit.DOUBLE_PRECISION:
+        fmat = '% .17e'
+    elif precision == myokit.SINGLE_PRECISION:
+        fmat = '% .9e'
+    else:
+        raise ValueError('Precision level not supported.')
+
+    # Get column order, as in DataLog.save_csv
+    if order:
+        keys = [str(x) for x in order]
+        if set(keys) != set(log.keys()):
+            raise ValueError(
+                'The given `order` sequence must contain all the same'
+                ' keys present in the log.')
+    else:
+        time = log.time_key()
+        keys = [time] if time in log else []
+        keys.extend(sorted(
+            [x for x in log.keys() if x != time],
+            key=myokit.tools.natural_sort_key))
+    columns = [np.asarray(log[key], dtype=float) for key in keys]
+    n = len(columns[0]) if columns else 0
+
+    eol = '\r\n'
+    line = delimiter.join([fmat] * len(keys)) + eol
+    with open(os.path.expanduser(filename), 'wb') as f:
+        if header:
+            names = ['"' + key.replace('"', '""') + '"' for key in keys]
+            f.write((delimiter.join(names) + eol).encode('ascii'))
+        for i in range(0, n, chunk_size):
+            rows = np.column_stack([c[i:i + chunk_size] for c in columns])
+            f.write(((line * len(rows)) % tuple(rows.ravel())).encode('ascii'))
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(
+        description='Compare CSV reading and writing with DataLog methods.')
+    parser.add_argument(
+        '-n', '--rows', type=int, default=10**7,
+        help='The number of rows in the test file.')
+    parser.add_argument(
+        '-c', '--columns', type=int, default=4,
+        help='The number of columns in the test file.')
+    parser.add_argument(
+        '--skip-datalog', action='store_true',
+        help='Only test the methods in this file.')
+    args = parser.parse_args()
+
+    # Create test log
+    d = myokit.DataLog(time='engine.time')
+    d['engine.time'] = np.linspace(0, 1000, args.rows)
+    for i in range(1, args.columns):
+        d[f'x.y{i}'] = np.sin(d['engine.time'] / i)
+    keys = ['engine.time', 'x.y1']
+    print(f'Log with {args.rows} rows and {args.columns} columns')
+
+    b = myokit.tools.Benchmarker()
+    path = tempfile.mkdtemp()
+    try:
+        f1 = os.path.join(path, 'datalog.csv')
+        f2 = os.path.join(path, 'fast.csv')
+
+        b.reset()
+        save_csv(d, f2)
+        print(f'fastcsv.save_csv:               {b.time():>8.1f} s')
+        if not args.skip_datalog:
+            b.reset()
+            d.save_csv(f1)
+            print(f'DataLog.save_csv:               {b.time():>8.1f} s')
+            with open(f1, 'rb') as x, open(f2, 'rb') as y:
+                print('Files identical:', x.read() == y.read())
+        del d
+
+        if not args.skip_datalog:
+            b.reset()
+            myokit.DataLog.load_csv(f2)
+            print(f'DataLog.load_csv:               {b.time():>8.1f} s')
+        b.reset()
+        load_csv(f2)
+        print(f'fastcsv.load_csv:               {b.time():>8.1f} s')
+        b.reset()
+        load_csv(f2, keys)
+        print(f'fastcsv.load_csv, 2 columns:    {b.time():>8.1f} s')
+    finally:
+        shutil.rmtree(path)
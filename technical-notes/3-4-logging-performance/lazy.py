@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+#
+# Loads DataLogs stored with DataLog.save() lazily, using memory-mapping.
+#
+import mmap
+import os
+import struct
+import tempfile
+import zipfile
+
+import myokit
+import numpy as np
+
+
+# Format of a zip file's local file header
+_local_header = struct.Struct('<4s5H3I2H')
+
+
+def save_stored(log, filename, precision=myokit.DOUBLE_PRECISION):
+    """
+    Stores a :class:`myokit.DataLog` in the same format as
+    :meth:`myokit.DataLog.save`, but without compressing the data, so that it
+    can be memory-mapped by :class:`LazyLog`.
+
+    The result can still be read with :meth:`myokit.DataLog.load`.
+    """
+    log.validate()
+    double = precision == myokit.DOUBLE_PRECISION
+    dtype = '<f8' if double else '<f4'
+    n = len(next(iter(log.values()))) if len(log) else 0
+
+    # Number of fields, length of data arrays, data type, time, fields
+    head = [str(len(log)), str(n), 'd' if double else 'f']
+    head.append(log.time_key() or '')
+    head.extend(log.keys())
+    head = '\n'.join(head).encode('utf8')
+
+    # Add an extra field to the header, so that the data starts at a multiple
+    # of 8 bytes (assuming a 20 byte zip64 extra field is added as well).
+    body = zipfile.ZipInfo('data.bin')
+    body.compress_type = zipfile.ZIP_STORED
+    pad = 4 + (-(_local_header.size + len(body.filename) + 20 + 4) % 8)
+    body.extra = struct.pack('<HH', 0xcafe, pad - 4) + b'\x00' * (pad - 4)
+
+    with zipfile.ZipFile(filename, 'w', allowZip64=True) as f:
+        with f.open(body, 'w', force_zip64=True) as g:
+            for v in log.values():
+                g.write(np.ascontiguousarray(v, dtype=dtype).tobytes())
+        f.writestr('structure.txt', head, zipfile.ZIP_DEFLATED)
+
+
+class LazyLog(object):
+    """
+    Provides lazy, read-only access to a :class:`myokit.DataLog` stored at
+    ``filename`` with :meth:`myokit.DataLog.save` or :meth:`save_stored`.
+
+    If the data in the zip file is stored without compression (as with
+    :meth:`save_stored`), the file is memory-mapped and each column is returned
+    as a numpy array that points directly into the map. Data is then only read
+    from disk (and only takes up memory) when it is accessed.
+
+    Files created with :meth:`myokit.DataLog.save` are compressed, and so must
+    be decompressed first. This is done once, into a temporary file that is
+    then memory-mapped and deleted when the log is closed.
+    """
+    def __init__(self, filename):
+        self._file = self._temp = self._map = None
+        filename = os.path.expanduser(filename)
+
+        with zipfile.ZipFile(filename, 'r') as z:
+            # Read structure
+            head = z.read('structure.txt').decode('utf8').splitlines()
+            nfields, n = int(head[0]), int(head[1])
+            dtype = np.dtype('<f8' if head[2] == 'd' else '<f4')
+            self._time = head[3] or None
+            self._keys = head[4:4 + nfields]
+
+            # Find data
+            info = z.getinfo('data.bin')
+            if info.compress_type == zipfile.ZIP_STORED:
+                self._file = open(filename, 'rb')
+                self._file.seek(info.header_offset)
+                h = _local_header.unpack(self._file.read(_local_header.size))
+                offset = info.header_offset + _local_header.size + h[9] + h[10]
+            else:
+                self._temp = tempfile.TemporaryFile()
+                with z.open(info, 'r') as f:
+                    while True:
+                        chunk = f.read(2**24)
+                        if not chunk:
+                            break
+                        self._temp.write(chunk)
+                self._temp.flush()
+                offset = 0
+
+        # Create map and views
+        self._columns = {}
+        if n > 0 and nfields > 0:
+            f = self._file or self._temp
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for i, key in enumerate(self._keys):
+                self._columns[key] = np.frombuffer(
+                    self._map, dtype=dtype, count=n,
+                    offset=offset + i * n * dtype.itemsize)
+        else:
+            for key in self._keys:
+                self._columns[key] = np.zeros(0, dtype=dtype)
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getitem__(self, key):
+        return self._columns[key]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def close(self):
+        """
+        Closes the underlying file(s).
+
+        Arrays obtained from this log remain valid, as the memory-map is only
+        closed once all arrays pointing into it have been deleted.
+        """
+        self._columns = {}
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Arrays pointing into the map still exist: the map will be
+                # closed when the last one is deleted.
+                pass
+            self._map = None
+        for f in (self._file, self._temp):
+            if f is not None:
+                f.close()
+        self._file = self._temp = None
+
+    def keys(self):
+        """
+        Returns a list of the keys in this log.
+        """
+        return list(self._keys)
+
+    def npview(self):
+        """
+        Returns a :class:`myokit.DataLog` containing (read-only) numpy arrays
+        that point directly into the memory-mapped file.
+        """
+        d = myokit.DataLog()
+        for key in self._keys:
+            d[key] = self._columns[key]
+        if self._time is not None:
+            d.set_time_key(self._time)
+        return d
+
+    def time(self):
+        """
+        Returns the logged time, or ``None`` if no time key was set.
+        """
+        return None if self._time is None else self._columns[self._time]
+
+    def time_key(self):
+        """
+        Returns the key used for time, or ``None`` if not set.
+        """
+        return self._time
+
+    def window(self, tmin=None, tmax=None, keys=None):
+        """
+        Returns a :class:`myokit.DataLog` with views of the data logged at
+        times ``tmin <= t < tmax`` (optionally only for the variables in
+        ``keys``).
+
+        The window is found with a binary search on the (sorted) time array, so
+        that only a few pages of it are read from disk.
+        """
+        if self._time is None:
+            raise ValueError('A time key is required to select a window.')
+        t = self._columns[self._time]
+        i = 0 if tmin is None else int(np.searchsorted(t, tmin, 'left'))
+        j = len(t) if tmax is None else int(np.searchsorted(t, tmax, 'left'))
+
+        d = myokit.DataLog()
+        keys = list(self._keys if keys is None else keys)
+        if self._time not in keys:
+            keys.insert(0, self._time)
+        for key in keys:
+            d[key] = self._columns[key][i:j]
+        d.set_time_key(self._time)
+        return d
+
+
+if __name__ == '__main__':
+    import argparse
+    import gc
+    import shutil
+
+    import psutil
+
+    parser = argparse.ArgumentParser(
+        description='Compare lazy and normal loading of DataLog zip files.')
+    parser.add_argument(
+        '-n', '--rows', type=int, default=2 * 10**6,
+        help='The number of rows in the test log.')
+    parser.add_argument(
+        '-c', '--columns', type=int, default=8,
+        help='The number of columns in the test log.')
+    args = parser.parse_args()
+
+    process = psutil.Process()
+    b = myokit.tools.Benchmarker()
+
+    def measure(name, f):
+        gc.collect()
+        r0 = process.memory_info().rss
+        b.reset()
+        x = f()
+        t = b.time()
+        r1 = process.memory_info().rss
+        print(f'{name:<42}{t * 1000:>10.1f} ms{(r1 - r0) / 2**20:>10.1f} MiB')
+        return x
+
+    # Create test log
+    d = myokit.DataLog(time='engine.time')
+    d['engine.time'] = np.linspace(0, 1000, args.rows)
+    for i in range(1, args.columns):
+        d[f'x.y{i}'] = np.sin(d['engine.time'] / i)
+    print(f'Log with {args.rows} rows and {args.columns} columns'
+          f' ({8 * args.rows * args.columns / 2**20:.0f} MiB)')
+
+    path = tempfile.mkdtemp()
+    try:
+        f1 = os.path.join(path, 'normal.zip')
+        f2 = os.path.join(path, 'stored.zip')
+        d.save(f1)
+        save_stored(d, f2)
+        del d
+
+        def plot_window(log):
+            w = log.window(400, 401, ['x.y1'])
+            return float(np.max(w['x.y1']))
+
+        print(f'{"":<42}{"time":>13}{"Δ RSS":>14}')
+        d = measure('DataLog.load, compressed',
+                    lambda: myokit.DataLog.load(f1))
+        del d
+        d = measure('LazyLog, compressed', lambda: LazyLog(f1))
+        measure('LazyLog, compressed, window', lambda: plot_window(d))
+        d.close()
+        d = measure('LazyLog, stored', lambda: LazyLog(f2))
+        measure('LazyLog, stored, window', lambda: plot_window(d))
+        measure('LazyLog, stored, whole column', lambda: np.sum(d['x.y1']))
+        d.close()
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#
+# Streams simulation logs to disk, so that memory use stays bounded for long
+# simulations.
+#
+import json
+import os
+
+import myokit
+import numpy as np
+
+
+class StreamWriter(object):
+    """
+    Writes logged data to a directory at ``path``, with one append-only binary
+    file per variable, and an index file ``index.json``.
+
+    Each binary file contains the logged values as little-endian 64-bit floats,
+    without any header, so that it can be memory-mapped when reading.
+
+    If ``path`` already exists, it must contain a stream with the same
+    variables, and new data is appended to it.
+    """
+    def __init__(self, path, keys, time=None):
+        self._path = path
+        self._keys = list(keys)
+        if len(set(self._keys)) != len(self._keys):
+            raise ValueError('Duplicate keys given.')
+        if time is not None and time not in self._keys:
+            raise ValueError('Time key must be one of the logged keys.')
+        self._time = time
+        self._rows = 0
+
+        # Create or check directory
+        index = os.path.join(path, 'index.json')
+        if os.path.exists(index):
+            with open(index, 'r') as f:
+                info = json.load(f)
+            if info['keys'] != self._keys:
+                raise ValueError(
+                    f'Existing stream at {path} has different keys.')
+            self._rows = info['rows']
+        else:
+            os.makedirs(path, exist_ok=True)
+
+        # Open files, cutting off any data written after the last index update
+        self._files = []
+        for i, key in enumerate(self._keys):
+            f = open(os.path.join(path, f'{i}.bin'), 'ab')
+            f.truncate(8 * self._rows)
+            self._files.append(f)
+        self._write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, log):
+        """
+        Appends the data in ``log`` (a :class:`myokit.DataLog` or any other
+        dict mapping the keys to equal-length sequences) to the stream.
+        """
+        columns = [np.asarray(log[key], dtype='<f8') for key in self._keys]
+        n = len(columns[0]) if columns else 0
+        if any(len(c) != n for c in columns):
+            raise ValueError('All logged sequences must have the same length.')
+        for f, c in zip(self._files, columns):
+            c.tofile(f)
+            f.flush()
+        self._rows += n
+        self._write_index()
+
+    def close(self):
+        """
+        Closes all files.
+        """
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def rows(self):
+        """
+        Returns the number of rows written so far.
+        """
+        return self._rows
+
+    def _write_index(self):
+        """
+        Writes the index file, which also records how many rows have been
+        written completely.
+        """
+        info = {'keys': self._keys, 'time': self._time, 'rows': self._rows}
+        temp = os.path.join(self._path, 'index.json.tmp')
+        with open(temp, 'w') as f:
+            json.dump(info, f, indent=1)
+        os.replace(temp, os.path.join(self._path, 'index.json'))
+
+
+class StreamReader(object):
+    """
+    Provides lazy, read-only access to a stream written by
+    :class:`StreamWriter`.
+
+    Columns are returned as memory-mapped numpy arrays, so that data is only
+    read from disk when it is accessed.
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            info = json.load(f)
+        self._keys = info['keys']
+        self._time = info['time']
+        self._rows = info['rows']
+        self._columns = {}
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __getitem__(self, key):
+        try:
+            return self._columns[key]
+        except KeyError:
+            pass
+        i = self._keys.index(key)
+        if self._rows == 0:
+            c = np.zeros(0)
+        else:
+            c = np.memmap(os.path.join(self._path, f'{i}.bin'), dtype='<f8',
+                          mode='r', shape=(self._rows, ))
+        self._columns[key] = c
+        return c
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        """
+        Returns a list of the keys in this stream.
+        """
+        return list(self._keys)
+
+    def rows(self):
+        """
+        Returns the number of logged points.
+        """
+        return self._rows
+
+    def time(self):
+        """
+        Returns the logged time, or ``None`` if no time key was set.
+        """
+        return None if self._time is None else self[self._time]
+
+    def time_key(self):
+        """
+        Returns the key used for time, or ``None`` if not set.
+        """
+        return self._time
+
+    def to_datalog(self, keys=None, start=0, stop=None):
+        """
+        Reads the stream (or only the columns in ``keys``, and only the rows
+        from ``start`` to ``stop``) into a :class:`myokit.DataLog`.
+        """
+        d = myokit.DataLog()
+        keys = self._keys if keys is None else keys
+        if self._time in keys:
+            d.set_time_key(self._time)
+        for key in keys:
+            d[key] = np.array(self[key][start:stop])
+        return d
+
+
+def run(sim, duration, path, chunk=1000, log=None, log_interval=None):
+    """
+    Runs the simulation ``sim`` for ``duration`` time units, and streams the
+    logged results to ``path``, using a :class:`StreamWriter`.
+
+    The simulation is run in parts of ``chunk`` time units, and the results of
+    each part are written to disk before the next part is run. As a result,
+    memory use depends on the chunk size, but not on the total duration.
+
+    The arguments ``log`` and ``log_interval`` are passed to
+    :meth:`myokit.Simulation.run`. Note that the solver is restarted at the
+    start of every chunk, so that the results will differ slightly from a
+    single run (within the solver tolerance). With dynamic logging (no
+    ``log_interval``) the logged time points will also differ, and as each
+    part starts by logging its initial point, which is also the last point of
+    the previous part, the first row of every part after the first is
+    dropped, so that no time point is stored twice.
+
+    Returns a :class:`StreamReader` for the written data.
+    """
+    duration, chunk = float(duration), float(chunk)
+    if chunk <= 0:
+        raise ValueError('Chunk size must be greater than zero.')
+
+    writer = None
+    tmax = sim.time() + duration
+    try:
+        for i in range(int(np.ceil(duration / chunk))):
+            t = min(chunk, tmax - sim.time())
+            d = sim.run(t, log=log, log_interval=log_interval)
+            if writer is None:
+                writer = StreamWriter(path, d.keys(), d.time_key())
+            elif log_interval is None:
+                d = {key: value[1:] for key, value in d.items()}
+            writer.append(d)
+            del d
+    finally:
+        if writer is not None:
+            writer.close()
+    return StreamReader(path)
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+    import tracemalloc
+
+    parser = argparse.ArgumentParser(
+        description='Compare streamed and in-memory logging.')
+    parser.add_argument(
+        'model', nargs='?', default='example',
+        help='The model to simulate.')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=20000,
+        help='The simulated time (ms).')
+    parser.add_argument(
+        '-c', '--chunk', type=float, default=1000,
+        help='The simulated time per chunk (ms).')
+    args = parser.parse_args()
+
+    m, p, _ = myokit.load(args.model)
+    s = myokit.Simulation(m, p)
+    log = myokit.LOG_INTER + myokit.LOG_BOUND
+    b = myokit.tools.Benchmarker()
+    path = tempfile.mkdtemp()
+
+    def in_memory():
+        return len(s.run(args.duration, log=log).time())
+
+    def streamed():
+        shutil.rmtree(os.path.join(path, 'log'), ignore_errors=True)
+        r = run(s, args.duration, os.path.join(path, 'log'), args.chunk, log)
+        return r.rows()
+
+    try:
+        for name, f in (('In memory', in_memory), ('Streamed', streamed)):
+            # Time without tracemalloc, which slows down allocation
+            s.reset()
+            b.reset()
+            n = f()
+            t = b.time()
+
+            # Measure peak memory allocated by Python
+            s.reset()
+            tracemalloc.start()
+            f()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{name + ":":<11}{n} points in {t:.2f} s,'
+                  f' peak {peak / 2**20:.1f} MiB')
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+#
+# Stores models and expressions in a compact binary format, that can be loaded
+# without parsing.
+#
+import array
+import copyreg
+import marshal
+
+import myokit
+
+
+# Format version, stored in every file
+VERSION = 1
+
+# Expression classes that can be stored
+_classes = [
+    x for x in vars(myokit).values()
+    if isinstance(x, type) and issubclass(x, myokit.Expression)]
+
+
+class _Writer(object):
+    """
+    Converts expressions to a flat, postfix representation.
+
+    Each expression is stored as a sequence of nodes, with an operator code and
+    a number of operands for each node. Numbers and names are stored in
+    separate arrays, along with the units used by numbers.
+
+    Variables are stored as indices into ``variables`` (a dict mapping
+    variables to indices), or as fully qualified names if no dict is given.
+    """
+    def __init__(self, variables=None):
+        self.variables = variables
+        self.codes = {}
+        self.units = {}
+        self.ops = bytearray()
+        self.arity = bytearray()
+        self.numbers = []
+        self.number_units = []
+        self.names = []
+
+    def add(self, e):
+        """ Adds an expression, and returns its number of nodes. """
+        n, arity = 1, 0
+        for x in e:
+            n += self.add(x)
+            arity += 1
+        if isinstance(e, myokit.Number):
+            self.numbers.append(e.eval())
+            self.number_units.append(self.unit(e.unit()))
+        elif isinstance(e, myokit.Name):
+            var = e.var()
+            if isinstance(var, myokit.Variable):
+                if self.variables is None:
+                    var = var.qname()
+                else:
+                    var = self.variables[var]
+            self.names.append(var if isinstance(var, int) else str(var))
+        self.ops.append(self.code(type(e)))
+        self.arity.append(arity)
+        return n
+
+    def code(self, cls):
+        """ Returns the operator code for an expression class. """
+        try:
+            return self.codes[cls]
+        except KeyError:
+            if cls not in _classes:
+                raise ValueError(f'Unsupported expression type: {cls}.')
+            self.codes[cls] = code = len(self.codes)
+            return code
+
+    def unit(self, unit):
+        """ Returns the index of a unit in the unit table, or -1 for None. """
+        if unit is None:
+            return -1
+        key = (tuple(unit.exponents()), unit.multiplier_log_10())
+        try:
+            return self.units[key]
+        except KeyError:
+            self.units[key] = i = len(self.units)
+            return i
+
+    def tables(self):
+        """ Returns the stored data as a tuple of simple types. """
+        codes = sorted(self.codes, key=lambda x: self.codes[x])
+        names = tuple(self.names)
+        if self.variables is not None:
+            names = array.array('i', names).tobytes()
+        return (
+            tuple(x.__name__ for x in codes),
+            tuple(self.units),
+            bytes(self.ops),
+            bytes(self.arity),
+            array.array('d', self.numbers).tobytes(),
+            array.array('h', self.number_units).tobytes(),
+            names,
+        )
+
+
+class _Reader(object):
+    """
+    Recreates expressions stored by a :class:`_Writer`.
+
+    Stored variable indices are converted using the list ``variables``. Stored
+    names are resolved with the model ``context``, or used as strings if no
+    context is given.
+    """
+    def __init__(self, tables, variables=None, context=None):
+        codes, units, ops, arity, numbers, number_units, names = tables
+        self.classes = [getattr(myokit, x) for x in codes]
+        self.units = [myokit.Unit(list(x), m) for x, m in units]
+        self.nodes = zip(ops, arity)
+        self.numbers = iter(array.array('d', numbers))
+        self.number_units = iter(array.array('h', number_units))
+        if isinstance(names, bytes):
+            names = array.array('i', names)
+        self.names = iter(names)
+        self.variables = variables
+        self.context = context
+
+    def next(self, n):
+        """ Reads and returns an expression with ``n`` nodes. """
+        stack = []
+        for i in range(n):
+            op, arity = next(self.nodes)
+            cls = self.classes[op]
+            if cls is myokit.Number:
+                u = next(self.number_units)
+                stack.append(myokit.Number(
+                    next(self.numbers), None if u < 0 else self.units[u]))
+            elif cls is myokit.Name:
+                var = next(self.names)
+                if isinstance(var, int):
+                    var = self.variables[var]
+                elif self.context is not None:
+                    var = self.context.get(var)
+                stack.append(myokit.Name(var))
+            else:
+                i = len(stack) - arity
+                args = stack[i:]
+                del stack[i:]
+                stack.append(cls(*args))
+        return stack[0]
+
+
+def dumps_expression(expression):
+    """
+    Stores a :class:`myokit.Expression` as bytes.
+
+    Variables are stored by their fully qualified names, so that the
+    expression can be recreated with or without a model, see
+    :meth:`loads_expression`.
+    """
+    w = _Writer()
+    n = w.add(expression)
+    return marshal.dumps((VERSION, 'expression', n, w.tables()))
+
+
+def loads_expression(data, context=None):
+    """
+    Recreates a :class:`myokit.Expression` stored with
+    :meth:`dumps_expression`.
+
+    If a :class:`myokit.Model` is given as ``context``, any variable names are
+    resolved using that model. If not, the expression will contain
+    :class:`myokit.Name` objects that refer to strings, as with
+    :meth:`myokit.parse_expression`.
+    """
+    version, kind, n, tables = marshal.loads(data)
+    if version != VERSION or kind != 'expression':
+        raise ValueError('Unsupported format.')
+    return _Reader(tables, context=context).next(n)
+
+
+def dumps_model(model):
+    """
+    Stores a :class:`myokit.Model` as bytes.
+
+    Variables are stored as a flat list, with each variable's parent, meta
+    data, unit, binding, and label, and the number of nodes in its right-hand
+    side. All expressions (right-hand sides and initial values) are stored
+    in a single postfix sequence, see :meth:`loads_model`.
+    """
+    variables = {}
+    for i, var in enumerate(model.variables(deep=True)):
+        variables[var] = i
+    components = {c: i for i, c in enumerate(model.components())}
+
+    w = _Writer(variables)
+    vs = []
+    for var in variables:
+        parent = var.parent()
+        if isinstance(parent, myokit.Component):
+            parent = -1 - components[parent]
+        else:
+            parent = variables[parent]
+        n = 0 if var.rhs() is None else w.add(var.rhs())
+        vs.append((
+            parent, var.name(), tuple(var.meta.items()), w.unit(var.unit()),
+            var.binding(), var.label(), n))
+    states = tuple(
+        (variables[x], w.add(x.initial_value())) for x in model.states())
+
+    cs = []
+    for c in components:
+        aliases = tuple((k, variables[v]) for k, v in c._alias_map.items())
+        cs.append((c.name(), tuple(c.meta.items()), aliases))
+
+    return marshal.dumps((
+        VERSION,
+        'model',
+        tuple(model.meta.items()),
+        tuple(cs),
+        tuple(vs),
+        states,
+        tuple(model._reserved_unames),
+        tuple(model._reserved_uname_prefixes.items()),
+        w.tables(),
+    ))
+
+
+def loads_model(data):
+    """
+    Recreates a :class:`myokit.Model` stored with :meth:`dumps_model`.
+
+    Unlike :meth:`myokit.parse_model`, this does not tokenise or parse any
+    text, and does not validate the model, but calls the model API directly,
+    in the same way as :meth:`myokit.Model.clone`.
+    """
+    (version, kind, meta, cs, vs, states, unames, prefixes,
+     tables) = marshal.loads(data)
+    if version != VERSION or kind != 'model':
+        raise ValueError('Unsupported format.')
+
+    # Create components and variables
+    model = myokit.Model()
+    for k, v in meta:
+        model.meta[k] = v
+    components = []
+    for name, meta, aliases in cs:
+        c = model.add_component(name)
+        for k, v in meta:
+            c.meta[k] = v
+        components.append(c)
+    variables = []
+    for parent, name, meta, unit, binding, label, n in vs:
+        parent = components[-1 - parent] if parent < 0 else variables[parent]
+        var = parent.add_variable(name)
+        for k, v in meta:
+            var.meta[k] = v
+        variables.append(var)
+
+    # Create states, in the stored order
+    for i, n in states:
+        variables[i].promote()
+
+    # Add aliases
+    for c, (name, meta, aliases) in zip(components, cs):
+        for k, i in aliases:
+            c.add_alias(k, variables[i])
+
+    # Add units, bindings, labels, and equations
+    r = _Reader(tables, variables)
+    for var, (parent, name, meta, unit, binding, label, n) in zip(
+            variables, vs):
+        if unit >= 0:
+            var.set_unit(r.units[unit])
+        if binding is not None:
+            var.set_binding(binding)
+        if label is not None:
+            var.set_label(label)
+        if n:
+            var.set_rhs(r.next(n))
+    for i, n in states:
+        variables[i].set_initial_value(r.next(n))
+
+    model.reserve_unique_names(*unames)
+    for prefix, prepend in prefixes:
+        model.reserve_unique_name_prefix(prefix, prepend)
+    return model
+
+
+def _reduce_expression(expression):
+    return loads_expression, (dumps_expression(expression), )
+
+
+def _reduce_model(model):
+    return loads_model, (dumps_model(model), )
+
+
+def register():
+    """
+    Makes :mod:`pickle` use :meth:`dumps_model` and :meth:`dumps_expression`
+    for models and expressions.
+
+    Expressions are pickled without their model, so that unpickled
+    expressions refer to variables by name (see :meth:`loads_expression`).
+    """
+    copyreg.pickle(myokit.Model, _reduce_model)
+    for cls in _classes:
+        copyreg.pickle(cls, _reduce_expression)
+
+
+def _count_states(model):
+    """ Returns the number of states in a model sent to a worker. """
+    return model.count_states()
+
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    import os
+    import pickle
+    import timeit
+
+    parser = argparse.ArgumentParser(
+        description='Compare compact storage with code() and parsing.')
+    parser.add_argument(
+        'model', nargs='?', default='../../examples/models/c/grandi-2011.mmt',
+        help='The model to test (uses the example model if not found).')
+    parser.add_argument(
+        '-n', '--tasks', type=int, default=50,
+        help='The number of tasks to send to a worker pool.')
+    args = parser.parse_args()
+
+    path = args.model if os.path.isfile(args.model) else 'example'
+    model = myokit.load_model(path)
+    print(f'Model {path}: {model.count_variables(deep=True)} variables')
+
+    def measure(name, f, number=20):
+        t = min(timeit.repeat(f, number=number, repeat=3)) / number
+        print(f'{name:<36}{t * 1000:>8.2f} ms')
+
+    # Model
+    code = model.code()
+    data = dumps_model(model)
+    print(f'Size of code():          {len(code):>8} bytes')
+    print(f'Size of dumps_model():   {len(data):>8} bytes')
+    measure('code()', model.code)
+    measure('parse_model()', lambda: myokit.parse_model(code))
+    measure('dumps_model()', lambda: dumps_model(model))
+    measure('loads_model()', lambda: loads_model(data))
+    measure('clone() (for reference)', model.clone)
+
+    # All expressions in the model
+    variables = [v for v in model.variables(deep=True) if v.rhs() is not None]
+    codes = [(v.rhs().code(), v) for v in variables]
+    datas = [dumps_expression(v.rhs()) for v in variables]
+    print(f'{len(variables)} expressions:')
+    measure('parse_expression()', lambda: [
+        myokit.parse_expression(c, context=v) for c, v in codes])
+    measure('loads_expression()', lambda: [
+        loads_expression(d, model) for d in datas])
+
+    # Sending the model to a pool of workers, once per task
+    tasks = [model] * args.tasks
+    print(f'Sending the model with {args.tasks} tasks to a worker pool:')
+    with multiprocessing.get_context('spawn').Pool(2) as pool:
+        pool.map(_count_states, tasks[:2])
+        measure('pickle (code() and parse)',
+                lambda: pool.map(_count_states, tasks, chunksize=1), 1)
+        register()
+        measure('pickle (compact)',
+                lambda: pool.map(_count_states, tasks, chunksize=1), 1)
+    assert pickle.loads(pickle.dumps(model)).code() == code
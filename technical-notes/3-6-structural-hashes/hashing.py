@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#
+# Calculates hashes of models, components, variables, and expressions, based
+# on their structure rather than their code.
+#
+import functools
+import hashlib
+import weakref
+
+import myokit
+
+
+# Cached hashes and references for each expression object. Expressions are
+# immutable, so these never need to be updated. References to variables are
+# stored as weak references: a strong reference would keep the variable's
+# model, and so the expression used as key, alive forever. Qualified names
+# can't be stored instead, as renaming a variable does not change the
+# expressions that refer to it.
+_expressions = weakref.WeakKeyDictionary()
+
+# Cached hashes for models, components, and variables, stored as tuples
+# ``(generation, digest)``, and the current generation of each model. These are
+# only used after calling :meth:`install`.
+_parts = weakref.WeakKeyDictionary()
+_generations = weakref.WeakKeyDictionary()
+_installed = False
+
+# Normalised unit representations
+_units = {}
+
+
+def _number(x):
+    """
+    Returns a normalised string representation of the float ``x``.
+
+    Numbers within a single rounding error of an integer are replaced by that
+    integer (as in :meth:`myokit.float.round`), and all other numbers are
+    written with 15 significant digits, so that numbers that differ only by a
+    rounding error (see :meth:`myokit.float.eq`) nearly always give the same
+    result.
+    """
+    x = myokit.float.round(x)
+    if isinstance(x, int):
+        return str(x)
+    return f'{x:.15g}'
+
+
+def _unit(unit):
+    """ Returns a normalised string representation of a unit. """
+    if unit is None:
+        return ''
+    try:
+        return _units[unit]
+    except KeyError:
+        pass
+    exponents = ','.join(_number(x) for x in unit.exponents())
+    _units[unit] = u = f'{exponents};{_number(unit.multiplier_log_10())}'
+    return u
+
+
+def _expression(e):
+    """
+    Returns a tuple ``(digest, references)`` for an expression, where
+    ``digest`` describes its structure with all references to variables
+    replaced by numbered placeholders, and ``references`` is a tuple of weak
+    references to the referenced variables (or names, if not linked to a
+    model).
+
+    Results are cached for each expression object, so that the expression
+    tree is only traversed once.
+    """
+    try:
+        return _expressions[e]
+    except KeyError:
+        pass
+
+    refs = []
+    slots = {}
+    parts = []
+
+    def walk(x):
+        # Write in postfix order, with the number of operands for each node
+        n = 0
+        for y in x:
+            walk(y)
+            n += 1
+        if isinstance(x, myokit.Number):
+            parts.append(f'#{_number(x.eval())}[{_unit(x.unit())}]')
+        elif isinstance(x, myokit.Name):
+            var = x.var()
+            try:
+                i = slots[var]
+            except KeyError:
+                i = slots[var] = len(refs)
+                if isinstance(var, myokit.Variable):
+                    var = weakref.ref(var)
+                refs.append(var)
+            parts.append(f'${i}')
+        else:
+            parts.append(f'{type(x).__name__}/{n}')
+
+    walk(e)
+    result = (
+        hashlib.blake2b(' '.join(parts).encode(), digest_size=16).digest(),
+        tuple(refs))
+    _expressions[e] = result
+    return result
+
+
+def _name(x):
+    """ Returns the fully qualified name of a (weak) reference. """
+    return x().qname() if isinstance(x, weakref.ref) else str(x)
+
+
+def _update(h, e):
+    """ Adds an expression (or ``None``) to the hash object ``h``. """
+    if e is None:
+        h.update(b'\0')
+        return
+    digest, refs = _expression(e)
+    h.update(digest)
+    for x in refs:
+        h.update(_name(x).encode() + b'\0')
+
+
+def _model_of(part):
+    """ Returns the model that a model part belongs to. """
+    return part if isinstance(part, myokit.Model) else part.model()
+
+
+def _cached(part, f):
+    """
+    Returns the hash for a model part, calculated with ``f(part)`` or taken
+    from the cache if :meth:`install` has been called.
+    """
+    if not _installed:
+        return f(part)
+    generation = _generations.get(_model_of(part), 0)
+    try:
+        g, digest = _parts[part]
+        if g == generation:
+            return digest
+    except KeyError:
+        pass
+    digest = f(part)
+    _parts[part] = (generation, digest)
+    return digest
+
+
+def _variable(var):
+    """ Returns the hash for a variable, as bytes. """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{var.name()}\0{var.binding()}\0{var.label()}\0'.encode())
+    h.update(f'{_unit(var.unit())}\0'.encode())
+    _update(h, var.rhs())
+    if var.is_state():
+        h.update(f'{var.index()}\0'.encode())
+        _update(h, var.initial_value())
+    for child in sorted(var.variables(), key=lambda x: x.name()):
+        h.update(_cached(child, _variable))
+    return h.digest()
+
+
+def _component(component):
+    """ Returns the hash for a component, as bytes. """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(component.name().encode() + b'\0')
+    for var in sorted(component.variables(), key=lambda x: x.name()):
+        h.update(_cached(var, _variable))
+    return h.digest()
+
+
+def _model(model):
+    """ Returns the hash for a model, as bytes. """
+    h = hashlib.blake2b(digest_size=16)
+    for c in sorted(model.components(), key=lambda x: x.name()):
+        h.update(_cached(c, _component))
+    return h.digest()
+
+
+def structural_hash(obj):
+    """
+    Returns a hash of a :class:`myokit.Model`, :class:`myokit.Component`,
+    :class:`myokit.Variable`, or :class:`myokit.Expression`, as a hexadecimal
+    string.
+
+    The hash depends on the names, equations, units, bindings, labels, state
+    order, and initial values of all variables. It does not depend on the
+    order in which components and variables are declared, on meta data, or on
+    aliases, and numbers that differ only by a rounding error nearly always
+    give the same hash (see :meth:`_number`).
+
+    Each expression is traversed only once, after which its structure is
+    cached. Because expressions in myokit are immutable, and any change to a
+    variable creates a new expression, cached results never need to be
+    invalidated: hashing a model that has changed only re-traverses the
+    expressions that were changed. After calling :meth:`install`, the hashes
+    of models, components, and variables are cached too.
+    """
+    if isinstance(obj, myokit.Model):
+        return _cached(obj, _model).hex()
+    elif isinstance(obj, myokit.Component):
+        return _cached(obj, _component).hex()
+    elif isinstance(obj, myokit.Variable):
+        return _cached(obj, _variable).hex()
+    elif isinstance(obj, myokit.Expression):
+        h = hashlib.blake2b(digest_size=16)
+        _update(h, obj)
+        return h.hexdigest()
+    raise ValueError(f'Unsupported type: {type(obj)}.')
+
+
+def _invalidate(part):
+    """
+    Removes the cached hashes for a model part and its parents.
+    """
+    while part is not None:
+        _parts.pop(part, None)
+        part = part.parent() if hasattr(part, 'parent') else None
+
+
+def _invalidate_all(part):
+    """
+    Invalidates the cached hashes for all parts of the model containing
+    ``part``, by starting a new generation.
+    """
+    model = _model_of(part)
+    if model is not None:
+        _generations[model] = _generations.get(model, 0) + 1
+
+
+# Methods that change a model, and the parts whose hashes they invalidate:
+# either the part they are called on (and its parents), or the whole model,
+# for changes that affect the hashes of other variables (e.g. renaming a
+# variable changes the hashes of all variables that refer to it).
+_methods = {
+    myokit.Model: {
+        _invalidate: [
+            'add_component', 'add_component_allow_renaming',
+            'import_component', 'remove_component'],
+        _invalidate_all: [
+            'remove_derivative_references', 'reorder_state',
+            'resolve_interdependent_components', 'set_initial_values',
+            'set_state', 'set_value', 'validate'],
+    },
+    myokit.Component: {
+        _invalidate: [
+            'add_variable', 'add_variable_allow_renaming', 'remove_variable'],
+        _invalidate_all: ['move_variable'],
+    },
+    myokit.Variable: {
+        _invalidate: [
+            'add_variable', 'add_variable_allow_renaming', 'remove_variable',
+            'remove_child_variables', 'set_binding', 'set_initial_value',
+            'set_label', 'set_rhs', 'set_state_value', 'set_unit'],
+        _invalidate_all: [
+            'convert_unit', 'demote', 'move_variable', 'promote', 'rename'],
+    },
+}
+
+
+def _wrap(method, invalidate):
+    """
+    Returns a version of ``method`` that calls ``invalidate`` before and after
+    running.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        invalidate(self)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            invalidate(self)
+    return wrapper
+
+
+def install():
+    """
+    Enables caching of model, component, and variable hashes.
+
+    Myokit does not notify anyone when a model changes, so this method
+    replaces all public methods that change a model's structure with versions
+    that also invalidate the cached hashes of the affected parts.
+
+    Most changes only invalidate the changed part and its parents, so that
+    re-hashing a model after e.g. ``set_rhs()`` only recalculates the hashes
+    of one variable, its component, and the model. Changes that affect other
+    variables (renaming, changing the state order, etc.) invalidate the whole
+    model.
+    """
+    global _installed
+    if _installed:
+        return
+    for cls, groups in _methods.items():
+        for invalidate, names in groups.items():
+            for name in names:
+                setattr(cls, name, _wrap(getattr(cls, name), invalidate))
+    _installed = True
+
+
+if __name__ == '__main__':
+    import argparse
+    import gc
+    import os
+    import timeit
+
+    parser = argparse.ArgumentParser(
+        description='Compare structural hashes with code() comparison.')
+    parser.add_argument(
+        'model', nargs='?', default='../../examples/models/c/grandi-2011.mmt',
+        help='The model to test (uses the example model if not found).')
+    args = parser.parse_args()
+
+    path = args.model if os.path.isfile(args.model) else 'example'
+    m1 = myokit.load_model(path)
+    m2 = m1.clone()
+    print(f'Model {path}: {m1.count_variables(deep=True)} variables')
+
+    def measure(name, f, number=100):
+        t = min(timeit.repeat(f, number=number, repeat=3)) / number
+        print(f'{name:<40}{t * 1e6:>10.1f} us')
+
+    measure('m1.code() == m2.code()', lambda: m1.code() == m2.code())
+    measure('Hash, new model (parse and hash)',
+            lambda: structural_hash(myokit.parse_model(m1.code())), 5)
+    measure('Parse only (for reference)',
+            lambda: myokit.parse_model(m1.code()), 5)
+    measure('Hash, cached expressions',
+            lambda: structural_hash(m1) == structural_hash(m2))
+    install()
+    measure('Hash, cached (after install())',
+            lambda: structural_hash(m1) == structural_hash(m2), 10000)
+    var = next(v for v in m1.variables(deep=True) if v.is_literal())
+    rhs = var.rhs()
+    measure(f'Hash after {var.qname()}.set_rhs()',
+            lambda: (var.set_rhs(rhs), structural_hash(m1)), 1000)
+
+    # Memoising simulation results
+    results = {}
+
+    def run(model):
+        key = structural_hash(model)
+        try:
+            return results[key]
+        except KeyError:
+            results[key] = d = myokit.Simulation(model).run(100)
+            return d
+
+    b = myokit.tools.Benchmarker()
+    run(m1)
+    b.reset()
+    run(m2)
+    t = b.time()
+    print(f'{"Memoised simulation of a clone":<40}{t * 1e6:>10.1f} us')
+
+    # Check that the caches don't keep hashed models alive
+    m3 = m1.clone()
+    structural_hash(m3)
+    ref = weakref.ref(m3)
+    n = len(_expressions)
+    del m3
+    gc.collect()
+    if ref() is not None:
+        raise RuntimeError('Hashed model was not garbage collected.')
+    print(f'Hashed model collected, cache size {n} -> {len(_expressions)}')
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+#
+# Runs simulations for a batch of parameter sets at once.
+#
+import multiprocessing
+
+import myokit
+import numpy as np
+
+
+class BatchSimulation(object):
+    """
+    Runs a simulation for many parameter sets, and returns the results as a
+    single numpy array.
+
+    Accepts the following input arguments:
+
+    ``model``
+        The model to simulate.
+    ``protocol``
+        An optional pacing protocol.
+    ``parameters``
+        A list of the variables to vary. Each entry can be the name of a
+        literal constant (e.g. ``ikr.gKr``), or an initial value of a state
+        written as ``init(x.y)``.
+    ``outputs``
+        A list of the names of the variables to return.
+    ``workers``
+        The number of processes to use. With ``workers=None`` or ``1`` all
+        simulations are run in the current process.
+
+    The model is compiled once, when the ``BatchSimulation`` is created. On
+    systems that support it, worker processes are created by forking the
+    current process, so that they can use the already compiled simulation. On
+    other systems, each worker process compiles the model once when it starts.
+    """
+    def __init__(self, model, protocol=None, parameters=None, outputs=None,
+                 workers=None):
+
+        # Check parameters
+        self._constants = []
+        self._initials = []
+        for i, name in enumerate(parameters or []):
+            if name.startswith('init(') and name.endswith(')'):
+                var = model.get(name[5:-1])
+                if not var.is_state():
+                    raise ValueError(f'Not a state variable: {var.qname()}.')
+                self._initials.append((i, var.index()))
+            else:
+                var = model.get(name)
+                if not var.is_literal():
+                    raise ValueError(f'Not a literal constant: {name}.')
+                self._constants.append((i, var.qname()))
+        self._n_parameters = len(self._constants) + len(self._initials)
+
+        # Check outputs
+        if not outputs:
+            raise ValueError('At least one output variable must be given.')
+        self._outputs = [model.get(x).qname() for x in outputs]
+
+        # Check workers
+        if workers is not None:
+            workers = int(workers)
+            if workers < 1:
+                raise ValueError(
+                    'The number of workers must be an integer greater than'
+                    ' zero.')
+        self._workers = workers
+
+        # Create (and compile) simulation
+        self._sim = myokit.Simulation(model, protocol)
+        self._default = self._sim.default_state()
+        self._defaults = {
+            name: model.get(name).eval() for i, name in self._constants}
+
+    def _run_chunk(self, parameters, times, duration):
+        """
+        Runs a simulation for each row in ``parameters``, and returns an array
+        of shape ``(n, len(times), len(outputs))``.
+        """
+        s = self._sim
+        out = np.empty((len(parameters), len(times), len(self._outputs)))
+        for i, p in enumerate(parameters):
+            s.reset()
+            for j, name in self._constants:
+                s.set_constant(name, p[j])
+            if self._initials:
+                x = list(self._default)
+                for j, k in self._initials:
+                    x[k] = p[j]
+                s.set_state(x)
+            try:
+                d = s.run(duration, log=self._outputs, log_times=times)
+            except myokit.SimulationError:
+                out[i] = np.nan
+                continue
+            for j, name in enumerate(self._outputs):
+                out[i, :, j] = d[name]
+
+        # Restore defaults
+        for name, value in self._defaults.items():
+            s.set_constant(name, value)
+        s.reset()
+        return out
+
+    def run(self, parameters, times, duration=None):
+        """
+        Runs a simulation for every parameter set in ``parameters`` (an array
+        of shape ``(n, p)``), and returns the values of the output variables at
+        the given ``times`` as an array of shape
+        ``(n, len(times), len(outputs))``.
+
+        Each simulation starts at ``t=0`` from the model's initial state (with
+        any initial values set by the parameters), and runs for ``duration``
+        time units (or until just after the last logged time).
+
+        If a simulation fails, its entries in the returned array are set to
+        ``nan``.
+        """
+        parameters = np.array(parameters, dtype=float, ndmin=2)
+        if parameters.shape[1] != self._n_parameters:
+            raise ValueError(
+                f'Expecting {self._n_parameters} parameters per set, got'
+                f' {parameters.shape[1]}.')
+        times = np.asarray(times, dtype=float)
+        if len(times) == 0 or np.any(np.diff(times) < 0) or times[0] < 0:
+            raise ValueError(
+                'Times must be a non-empty, non-decreasing sequence of'
+                ' non-negative values.')
+        if duration is None:
+            duration = np.nextafter(times[-1], np.inf)
+        elif duration <= times[-1]:
+            raise ValueError('Duration must be greater than the last time.')
+
+        n = len(parameters)
+        workers = min(self._workers or 1, n)
+        if workers == 1:
+            return self._run_chunk(parameters, times, duration)
+
+        # Divide over workers, using a few chunks per worker to balance the
+        # load without paying the communication overhead for every set.
+        chunks = np.array_split(parameters, min(n, 4 * workers))
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:  # pragma: no cover
+            ctx = multiprocessing.get_context()
+        global _worker
+        _worker = self
+        try:
+            with ctx.Pool(workers, _worker_init, (self, )) as pool:
+                results = pool.starmap(
+                    _worker_run, [(c, times, duration) for c in chunks],
+                    chunksize=1)
+        finally:
+            _worker = None
+        return np.concatenate(results)
+
+
+# Simulation used by the current worker process
+_worker = None
+
+
+def _worker_init(batch):
+    """
+    Initialises a worker process. With forking, the batch simulation is
+    already available; otherwise it's unpickled (and recompiled) here.
+    """
+    global _worker
+    if _worker is None:
+        _worker = batch
+
+
+def _worker_run(parameters, times, duration):
+    """
+    Runs a chunk of parameter sets in a worker process.
+    """
+    return _worker._run_chunk(parameters, times, duration)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(
+        description='Compare batched and one-by-one simulations.')
+    parser.add_argument(
+        '-n', '--sets', type=int, default=2000,
+        help='The number of parameter sets to evaluate.')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=os.cpu_count(),
+        help='The number of worker processes to use.')
+    args = parser.parse_args()
+
+    # Logistic model from technical note 2-4
+    model = myokit.parse_model("""
+        [[model]]
+        c.y = 1 / (1 + exp(-c.h * c.K * log(10)))
+
+        [engine]
+        time = 0 bind time
+
+        [c]
+        h = 1
+        K = -4
+        dot(y) = h * y * (1 - y)
+        """)
+    times = np.linspace(0, 20, 101)
+    rng = np.random.default_rng(1)
+    parameters = np.column_stack([
+        rng.uniform(0.5, 2, args.sets),         # c.h
+        rng.uniform(1e-4, 1e-2, args.sets),     # init(c.y)
+    ])
+    b = myokit.tools.Benchmarker()
+
+    # One at a time
+    s = myokit.Simulation(model)
+    b.reset()
+    y1 = np.zeros((args.sets, len(times), 1))
+    for i, (h, y0) in enumerate(parameters):
+        s.reset()
+        s.set_constant('c.h', h)
+        s.set_state([y0])
+        d = s.run(
+            np.nextafter(times[-1], np.inf), log=['c.y'], log_times=times)
+        y1[i, :, 0] = d['c.y']
+    print(f'One at a time:          {b.time():.2f} s')
+
+    # Batched, serial and in parallel
+    for workers in sorted(set([1, args.workers])):
+        batch = BatchSimulation(
+            model, parameters=['c.h', 'init(c.y)'], outputs=['c.y'],
+            workers=workers)
+        b.reset()
+        y2 = batch.run(parameters, times)
+        print(f'Batch, {workers} worker(s):     {b.time():.2f} s'
+              f' (max difference {np.max(np.abs(y2 - y1)):.1e})')
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+#
+# Evaluates ion current models under voltage-step protocols for many parameter
+# sets at once, using matrix exponentials.
+#
+import collections
+
+import myokit
+import myokit.formats.python
+import numpy as np
+
+
+class BatchAnalyticalModel(object):
+    """
+    Evaluates an ion current model with fixed membrane potential analytically,
+    for a batch of parameter sets at once.
+
+    Accepts the following input arguments:
+
+    ``model``
+        The model containing the ion current.
+    ``states``
+        A list of the current model's states.
+    ``parameters``
+        A list of (literal constant) variables to vary.
+    ``current``
+        The current variable.
+    ``vm``
+        The membrane potential variable. If not given, the method will look for
+        the label ``membrane_potential``.
+    ``cache_size``
+        The maximum number of eigendecompositions to cache.
+
+    With the membrane potential fixed, the states must follow a system of
+    the form ``dot(x) = A x + c``, where ``A`` and ``c`` depend only on the
+    parameters and the membrane potential. This includes Markov models (for
+    which ``c = 0``), and Hodgkin-Huxley models (for which ``A`` is diagonal).
+    The current can be any function of the states, parameters, and membrane
+    potential.
+
+    Each eigendecomposition of ``A`` is cached, using the membrane potential
+    and parameter values as key, so that repeated steps to the same voltage
+    (and repeated evaluations of the same parameters) are only solved once.
+    The ``cache_size`` most recently used decompositions are kept.
+    """
+    def __init__(self, model, states, parameters=None, current=None, vm=None,
+                 cache_size=4096):
+
+        # Get variables
+        self._states = [model.get(x) for x in states]
+        for x in self._states:
+            if not x.is_state():
+                raise ValueError(f'Not a state variable: {x.qname()}.')
+        self._parameters = [model.get(x) for x in (parameters or [])]
+        for x in self._parameters:
+            if not x.is_literal():
+                raise ValueError(f'Not a literal constant: {x.qname()}.')
+        if vm is None:
+            self._vm = model.label('membrane_potential')
+            if self._vm is None:
+                raise ValueError(
+                    'Membrane potential variable must be given by vm or'
+                    ' specified using the label "membrane_potential".')
+        else:
+            self._vm = model.get(vm)
+        self._current = None if current is None else model.get(current)
+
+        # Default parameters and state
+        self._default_parameters = np.array(
+            [x.eval() for x in self._parameters])
+        self._default_state = np.array(
+            [x.initial_value(True) for x in self._states])
+
+        # Create functions to evaluate A, c, and the current
+        self._generate_functions()
+
+        # Cached eigendecompositions
+        self._cache = collections.OrderedDict()
+        self._cache_size = int(cache_size)
+        self._hits = self._misses = 0
+
+    def _generate_functions(self):
+        """
+        Creates functions that evaluate ``A`` and ``c``, and the current, for
+        arrays of parameters.
+        """
+        retain = self._states + self._parameters + [self._vm]
+        names = {x: f'_x[{i}]' for i, x in enumerate(self._states)}
+        names.update({x: f'_p[{i}]' for i, x in enumerate(self._parameters)})
+        names[self._vm] = '_v'
+        w = myokit.formats.python.NumPyExpressionWriter()
+        w.set_lhs_function(lambda lhs: names[lhs.var()])
+        zero = {myokit.Name(x): myokit.Number(0) for x in self._states}
+
+        n = len(self._states)
+        body = ['def _system(_p, _v, _n):',
+                f'    _A = numpy.zeros((_n, {n}, {n}))',
+                f'    _c = numpy.zeros((_n, {n}))']
+        for i, x in enumerate(self._states):
+            rhs = x.rhs().clone(expand=True, retain=retain)
+            for j, y in enumerate(self._states):
+                e = rhs.diff(myokit.Name(y))
+                if any(r.var() in self._states for r in e.references()):
+                    raise ValueError(
+                        f'The derivative of {x.qname()} depends non-linearly'
+                        ' on the states.')
+                if not (e.is_literal() and e.eval() == 0):
+                    body.append(f'    _A[:, {i}, {j}] = {w.ex(e)}')
+            e = rhs.clone(subst=zero)
+            if not (e.is_literal() and e.eval() == 0):
+                body.append(f'    _c[:, {i}] = {w.ex(e)}')
+        body.append('    return _A, _c')
+
+        if self._current is not None:
+            rhs = self._current.rhs().clone(expand=True, retain=retain)
+            body.append('def _current(_x, _p, _v):')
+            body.append(f'    return {w.ex(rhs)} + numpy.zeros(_x[0].shape)')
+
+        local = {}
+        exec('\n'.join(body), {'numpy': np}, local)
+        self._system = local['_system']
+        self._current_function = local.get('_current')
+
+    def _decompose(self, parameters, v):
+        """
+        Returns arrays ``(E, P, PI, xs)`` with the eigenvalues and eigenvectors
+        of ``A``, the inverse of the eigenvector matrix, and the fixed point
+        ``x`` where ``A x + c = 0`` (or zeros if ``c = 0``), for each parameter
+        set at membrane potential ``v``.
+        """
+        N, n = len(parameters), len(self._states)
+        E = np.empty((N, n), dtype=complex)
+        P = np.empty((N, n, n), dtype=complex)
+        PI = np.empty((N, n, n), dtype=complex)
+        xs = np.zeros((N, n))
+
+        # Get cached decompositions
+        keys = [(v, p.tobytes()) for p in parameters]
+        todo = []
+        for i, key in enumerate(keys):
+            try:
+                E[i], P[i], PI[i], xs[i] = self._cache[key]
+                self._cache.move_to_end(key)
+            except KeyError:
+                todo.append(i)
+        self._hits += N - len(todo)
+        self._misses += len(todo)
+        if not todo:
+            return E, P, PI, xs
+
+        # Calculate missing decompositions, all at once
+        A, c = self._system(parameters[todo].T, v, len(todo))
+        e, p = np.linalg.eig(A)
+        pi = np.linalg.inv(p)
+        s = np.zeros(c.shape)
+        i = np.any(c != 0, axis=1)
+        if np.any(i):
+            s[i] = np.linalg.solve(A[i], -c[i, :, None])[:, :, 0]
+        E[todo], P[todo], PI[todo], xs[todo] = e, p, pi, s
+
+        # Store, and remove least recently used
+        for j, k in enumerate(todo):
+            self._cache[keys[k]] = (e[j], p[j], pi[j], s[j])
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return E, P, PI, xs
+
+    def cache_info(self):
+        """
+        Returns a tuple ``(hits, misses, size)`` describing the cache use.
+        """
+        return self._hits, self._misses, len(self._cache)
+
+    def default_parameters(self):
+        """
+        Returns the model's default parameter values.
+        """
+        return np.array(self._default_parameters)
+
+    def default_state(self):
+        """
+        Returns the model's default state.
+        """
+        return np.array(self._default_state)
+
+    def run(self, parameters, steps, times, state=None):
+        """
+        Evaluates the model under a voltage-step protocol, for every parameter
+        set in ``parameters`` (an array of shape ``(N, P)``).
+
+        The protocol is given as a list of tuples ``(voltage, duration)``,
+        starting at ``t=0``, and the states (and current) are evaluated at the
+        given ``times``. Times after the end of the protocol use the last
+        voltage.
+
+        Each evaluation starts from ``state`` (a single state, or an array of
+        shape ``(N, n)``), or from the model's initial state if not given.
+
+        Returns a tuple ``(states, current)``, where ``states`` has shape
+        ``(N, len(times), n)`` and ``current`` has shape ``(N, len(times))``
+        (or is ``None`` if no current was set).
+        """
+        parameters = np.array(parameters, dtype=float, ndmin=2)
+        N, n = len(parameters), len(self._states)
+        if parameters.shape[1] != len(self._parameters):
+            raise ValueError(
+                f'Expecting {len(self._parameters)} parameters per set, got'
+                f' {parameters.shape[1]}.')
+        times = np.asarray(times, dtype=float)
+        if np.any(np.diff(times) < 0) or (len(times) and times[0] < 0):
+            raise ValueError(
+                'Times must be a non-decreasing sequence of non-negative'
+                ' values.')
+        x = self._default_state if state is None else np.asarray(state, float)
+        x = np.array(np.broadcast_to(x, (N, n)))
+
+        out = np.zeros((N, len(times), n))
+        t0 = 0
+        for k, (v, duration) in enumerate(steps):
+            v = float(v)
+            t1 = np.inf if k == len(steps) - 1 else t0 + float(duration)
+            E, P, PI, xs = self._decompose(parameters, v)
+
+            # Use real arithmetic where possible (e.g. for HH models, and for
+            # Markov models that satisfy detailed balance), as this is several
+            # times faster.
+            if not np.any(E.imag):
+                E, P, PI = E.real, P.real, PI.real
+
+            # Solve x(t) = xs + P exp(E t) P^-1 (x0 - xs) at the logged times
+            # in this step, and at the end of the step.
+            i, j = np.searchsorted(times, [t0, t1])
+            dt = np.append(times[i:j] - t0, 0 if t1 == np.inf else t1 - t0)
+            y0 = np.matmul(PI, (x - xs)[:, :, None])
+            y = np.matmul(P, y0 * np.exp(E[:, :, None] * dt[None, None, :]))
+            y = y.real.transpose(0, 2, 1) + xs[:, None, :]
+            out[:, i:j] = y[:, :-1]
+            x = y[:, -1]
+            t0 = t1
+
+        # Calculate current
+        current = None
+        if self._current_function is not None:
+            current = np.zeros((N, len(times)))
+            t0 = 0
+            for k, (v, duration) in enumerate(steps):
+                t1 = np.inf if k == len(steps) - 1 else t0 + float(duration)
+                i, j = np.searchsorted(times, [t0, t1])
+                current[:, i:j] = self._current_function(
+                    out[:, i:j].transpose(2, 0, 1), parameters.T[:, :, None],
+                    float(v))
+                t0 = t1
+        return out, current
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import myokit.lib.markov
+
+    parser = argparse.ArgumentParser(
+        description='Compare batched analytical evaluation with simulations.')
+    parser.add_argument(
+        '-n', '--sets', type=int, default=200,
+        help='The number of parameter sets to evaluate.')
+    args = parser.parse_args()
+
+    # Four-state hERG model, with all states written out
+    model = myokit.parse_model("""
+        [[model]]
+        ikr.C = 1
+        ikr.O = 0
+        ikr.I = 0
+        ikr.CI = 0
+
+        [engine]
+        time = 0 bind time
+
+        [membrane]
+        V = -80 bind pace
+            label membrane_potential
+
+        [ikr]
+        use membrane.V
+        p1 = 2.26e-4
+        p2 = 0.0699
+        p3 = 3.45e-5
+        p4 = 0.05462
+        p5 = 0.0873
+        p6 = 8.91e-3
+        p7 = 5.15e-3
+        p8 = 0.03158
+        p9 = 0.1524
+        k1 = p1 * exp(p2 * V)
+        k2 = p3 * exp(-p4 * V)
+        k3 = p5 * exp(p6 * V)
+        k4 = p7 * exp(-p8 * V)
+        dot(C) = k2 * O + k4 * CI - (k1 + k3) * C
+        dot(O) = k1 * C + k4 * I - (k2 + k3) * O
+        dot(I) = k3 * O + k1 * CI - (k2 + k4) * I
+        dot(CI) = k3 * C + k2 * I - (k1 + k4) * CI
+        IKr = p9 * O * (V - -88)
+        """)
+    states = ['ikr.C', 'ikr.O', 'ikr.I', 'ikr.CI']
+    names = [f'ikr.p{i}' for i in range(1, 10)]
+
+    # Steps from a holding potential to a range of voltages, with a tail step
+    steps = []
+    for v in range(-60, 41, 10):
+        steps.extend([(-80, 1000), (v, 1000), (-50, 1000)])
+    duration = sum(d for v, d in steps)
+    times = np.arange(0, duration, 1)
+    protocol = myokit.Protocol()
+    for v, d in steps:
+        protocol.add_step(v, d)
+
+    rng = np.random.default_rng(1)
+    x = np.array([model.get(name).eval() for name in names])
+    parameters = x * rng.uniform(0.8, 1.25, (args.sets, len(x)))
+    print(f'{args.sets} parameter sets, {len(steps)} steps,'
+          f' {len(times)} points')
+    b = myokit.tools.Benchmarker()
+
+    # CVODES, one at a time
+    s = myokit.Simulation(model, protocol)
+    s.set_tolerance(1e-8, 1e-8)
+    i1 = np.zeros((args.sets, len(times)))
+    b.reset()
+    for k, p in enumerate(parameters):
+        s.reset()
+        for name, value in zip(names, p):
+            s.set_constant(name, value)
+        i1[k] = s.run(duration, log=['ikr.IKr'], log_times=times)['ikr.IKr']
+    print(f'CVODES, one at a time:         {b.time():>7.2f} s')
+
+    # Analytical, one at a time
+    m = myokit.lib.markov.LinearModel(model, states, names, 'ikr.IKr')
+    s = myokit.lib.markov.AnalyticalSimulation(m, protocol)
+    i2 = np.zeros((args.sets, len(times)))
+    b.reset()
+    for k, p in enumerate(parameters):
+        s.reset()
+        s.set_parameters(p)
+        i2[k] = s.run(duration, log_times=times)['ikr.IKr']
+    print(f'Analytical, one at a time:     {b.time():>7.2f} s'
+          f' (max difference {np.max(np.abs(i2 - i1)):.1e})')
+
+    # Analytical, batched
+    m = BatchAnalyticalModel(model, states, names, 'ikr.IKr')
+    for label in ('Batched', 'Batched, cached'):
+        b.reset()
+        i3 = m.run(parameters, steps, times)[1]
+        print(f'{label + ":":<31}{b.time():>7.2f} s'
+              f' (max difference {np.max(np.abs(i3 - i1)):.1e})')
+    hits, misses, size = m.cache_info()
+    print(f'Cache: {hits} hits, {misses} misses, {size} entries')
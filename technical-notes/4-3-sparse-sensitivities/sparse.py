@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#
+# Calculates sensitivities using only the part of a model that the dependent
+# variables depend on.
+#
+import myokit
+import numpy as np
+
+
+def dependencies(variables):
+    """
+    Returns the set of all variables that the given variables depend on,
+    including the variables themselves.
+
+    States are treated as depending on everything their derivative and their
+    initial value depend on, so that the returned set includes everything that
+    can affect the given variables during a simulation.
+    """
+    seen = set()
+    todo = list(variables)
+    while todo:
+        var = todo.pop()
+        if var in seen:
+            continue
+        seen.add(var)
+        todo.extend(ref.var() for ref in var.rhs().references())
+        if var.is_state():
+            todo.extend(
+                ref.var() for ref in var.initial_value().references())
+    return seen
+
+
+def _variable(model, name):
+    """
+    Returns the variable for a dependent or independent written as a string,
+    e.g. ``x.y``, ``dot(x.y)``, or ``init(x.y)``.
+    """
+    name = str(name)
+    for prefix in ('dot(', 'init('):
+        if name.startswith(prefix) and name.endswith(')'):
+            var = model.get(name[len(prefix):-1])
+            if not var.is_state():
+                raise ValueError(f'Not a state variable: {var.qname()}.')
+            return var
+    return model.get(name)
+
+
+def reduced_model(model, keep):
+    """
+    Returns a copy of ``model`` with only the variables in ``keep``, the
+    variables they depend on, and any bound variables.
+
+    States that are removed are first converted to constants, so that any
+    removed variables that depend on them can be removed too.
+    """
+    model = model.clone()
+    keep = dependencies([model.get(x.qname()) for x in keep])
+    keep.update(x for x in model.variables(deep=True) if x.is_bound())
+
+    # Convert unused states to constants
+    for var in list(model.states()):
+        if var not in keep:
+            value = var.initial_value(True)
+            var.demote()
+            var.set_rhs(value)
+
+    # Remove unused variables, starting from those that aren't referenced by
+    # anything else. Nested variables are removed along with their parent, if
+    # they are only referenced by each other.
+    def unused(var):
+        group = [var] + list(var.variables(deep=True))
+        if any(x in keep for x in group):
+            return False
+        group = set(group)
+        return all(y in group for x in group for y in x.refs_by())
+
+    removed = True
+    while removed:
+        removed = False
+        for var in list(model.variables(deep=True)):
+            if unused(var):
+                var.parent().remove_variable(var, recursive=True)
+                removed = True
+                break
+    for c in list(model.components()):
+        if len(c) == 0:
+            model.remove_component(c)
+    return model
+
+
+class SparseSensitivitySimulation(object):
+    """
+    Runs a simulation with sensitivities ``(dependents, independents)``, using
+    only the part of the model that the dependents depend on.
+
+    Accepts the following input arguments:
+
+    ``model``
+        The model to simulate.
+    ``protocol``
+        An optional pacing protocol.
+    ``sensitivities``
+        A tuple ``(dependents, independents)``, where the dependents are
+        written as ``x.y`` or ``dot(x.y)`` and the independents as ``x.y`` or
+        ``init(x.y)``, as for :class:`myokit.Simulation`.
+
+    Forward sensitivity calculations solve an extra ODE for every pair of a
+    state and an independent, so that their cost grows with the number of
+    states times the number of independents. This class first finds all
+    variables that the dependents depend on, and then:
+
+    1. Removes any states (and other variables) that the dependents do not
+       depend on from the simulated model.
+    2. Removes any independents that the dependents do not depend on from the
+       sensitivity calculation. Their sensitivities are zero.
+
+    The remaining model is simulated with a :class:`myokit.Simulation`.
+    Because removed variables cannot affect the dependents, the results are
+    the same as for the full model. This is most useful if the dependents only
+    depend on a small part of the model, e.g. a single current in a voltage
+    clamp experiment.
+    """
+    def __init__(self, model, protocol=None, sensitivities=None):
+        if sensitivities is None:
+            raise ValueError('Sensitivities must be given.')
+        ys = [str(y) for y in sensitivities[0]]
+        xs = [str(x) for x in sensitivities[1]]
+        if not ys or not xs:
+            raise ValueError(
+                'At least one dependent and one independent must be given.')
+
+        # Find dependencies of each dependent
+        deps = [dependencies([_variable(model, y)]) for y in ys]
+        self._structure = np.array(
+            [[_variable(model, x) in d for x in xs] for d in deps])
+
+        # Reduce model and list of independents
+        self._model = reduced_model(model, [_variable(model, y) for y in ys])
+        self._independents = np.nonzero(np.any(self._structure, axis=0))[0]
+        self._shape = (len(ys), len(xs))
+        sens = None
+        if len(self._independents):
+            sens = (ys, [xs[i] for i in self._independents])
+        self._sim = myokit.Simulation(self._model, protocol, sens)
+
+    def model(self):
+        """
+        Returns the (reduced) model used in the simulation.
+        """
+        return self._model
+
+    def reset(self):
+        """
+        Resets the simulation time and state.
+        """
+        self._sim.reset()
+
+    def run(self, duration, log=None, log_interval=None, log_times=None):
+        """
+        Runs a simulation and returns a tuple ``(log, sensitivities)``, where
+        ``sensitivities`` is an array of shape
+        ``(n_logged_points, n_dependents, n_independents)``.
+
+        Only variables in the reduced model can be logged.
+        """
+        if len(self._independents) == 0:
+            d = self._sim.run(duration, log=log, log_interval=log_interval,
+                              log_times=log_times)
+            n = len(next(iter(d.values()))) if len(d) else 0
+            return d, np.zeros((n, ) + self._shape)
+
+        d, e = self._sim.run(duration, log=log, log_interval=log_interval,
+                             log_times=log_times)
+        s = np.zeros((len(e), ) + self._shape)
+        s[:, :, self._independents] = e
+        return d, s
+
+    def set_tolerance(self, abs_tol=1e-6, rel_tol=1e-4):
+        """
+        Sets the solver tolerances, as in
+        :meth:`myokit.Simulation.set_tolerance`.
+        """
+        self._sim.set_tolerance(abs_tol, rel_tol)
+
+    def structure(self):
+        """
+        Returns a boolean array of shape ``(n_dependents, n_independents)``
+        that is ``False`` wherever a sensitivity is zero because the dependent
+        does not depend on the independent.
+        """
+        return np.array(self._structure)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+
+    # Models to test, relative to this directory
+    models = {
+        'example': 'example',
+        'grandi-2011': '../../examples/models/c/grandi-2011.mmt',
+    }
+
+    parser = argparse.ArgumentParser(
+        description='Compare sparse and dense sensitivity calculations.')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=6000,
+        help='The simulated time (ms).')
+    parser.add_argument(
+        '-p', '--parameters', type=int, nargs='+', default=[1, 3, 10, 30, 100],
+        help='The numbers of parameters to test.')
+    parser.add_argument(
+        '-r', '--repeats', type=int, default=5,
+        help='The number of times to repeat each run (the fastest is shown).')
+    args = parser.parse_args()
+
+    def first_current(model):
+        """
+        Returns the variable used in the membrane potential's derivative that
+        refers directly to the most states (other than the membrane potential).
+        """
+        v = model.label('membrane_potential')
+        best, most = None, 0
+        todo = [ref.var() for ref in v.rhs().references()]
+        seen = set()
+        while todo:
+            var = todo.pop()
+            if var in seen or var.is_state() or var.is_constant():
+                continue
+            seen.add(var)
+            refs = set(ref.var() for ref in var.rhs().references())
+            n = len([x for x in refs if x.is_state() and x is not v])
+            if n > most or (n == most and n and var.qname() < best.qname()):
+                best, most = var, n
+            todo.extend(refs)
+        if best is None:
+            raise ValueError('No current found.')
+        return best
+
+    def voltage_clamp(model):
+        """
+        Returns a copy of ``model`` with the membrane potential bound to the
+        pacing protocol, and a voltage-step protocol.
+        """
+        model = model.clone()
+        v = model.label('membrane_potential')
+        v.demote()
+        v.set_rhs(-80)
+        p = model.binding('pace')
+        if p is not None:
+            p.set_binding(None)
+        v.set_binding('pace')
+        protocol = myokit.Protocol()
+        for level in range(-60, 41, 20):
+            protocol.add_step(-80, 500)
+            protocol.add_step(level, 500)
+        return model, protocol
+
+    b = myokit.tools.Benchmarker()
+    print(f'{"Model":<14}{"Experiment":<16}{"Parameters":>10}'
+          f'{"States":>9}{"Dense":>11}{"Sparse":>11}')
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name, path in models.items():
+        if path != 'example':
+            path = os.path.join(here, path)
+        if path != 'example' and not os.path.isfile(path):
+            print(f'Skipping {name}: {path} not found.')
+            continue
+        model, protocol, _ = myokit.load(path)
+        v = model.label('membrane_potential')
+        clamped, steps = voltage_clamp(model)
+        experiments = {
+            'current clamp': (model, protocol, v.qname()),
+            'voltage clamp': (clamped, steps, first_current(model).qname()),
+        }
+        literals = [
+            x.qname() for x in model.variables(deep=True) if x.is_literal()]
+        counts = sorted(set(min(n, len(literals)) for n in args.parameters))
+
+        for experiment, (m, p, y) in experiments.items():
+            for n in counts:
+                sens = ([y], literals[:n])
+                times = []
+                for cls in (myokit.Simulation, SparseSensitivitySimulation):
+                    s = cls(m, p, sens)
+                    t = []
+                    for i in range(args.repeats):
+                        s.reset()
+                        b.reset()
+                        s.run(args.duration, log=[y], log_interval=1)
+                        t.append(b.time())
+                    times.append(min(t))
+                states = s.model().count_states()
+                print(f'{name:<14}{experiment:<16}{n:>10}'
+                      f'{states:>4} of {m.count_states():<3}'
+                      f'{times[0] * 1000:>8.1f} ms{times[1] * 1000:>8.1f} ms')
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# Stores compiled simulations on disk, so that they can be reused by other
+# processes (and later runs) without compiling again.
+#
+import hashlib
+import os
+import platform
+import sys
+import tempfile
+
+import myokit
+
+try:
+    import fcntl
+except ImportError:     # pragma: no cover
+    fcntl = None
+
+
+class SimulationCache(object):
+    """
+    A directory of compiled :class:`myokit.Simulation` objects, stored with
+    the ``path`` argument to :class:`myokit.Simulation`.
+
+    Accepts the following input arguments:
+
+    ``path``
+        The directory to store simulations in. Created if it doesn't exist.
+    ``max_size``
+        The maximum size of the cache, in bytes. When this is exceeded, the
+        least recently used simulations are removed.
+
+    Each simulation is stored under a hash of the model code, the pacing
+    labels and protocol types, the sensitivities, and the Myokit and Python
+    versions and platform, so that any change that requires a new C module
+    leads to a new entry.
+
+    On systems that support ``fcntl`` (Linux and macOS), a lock file is used
+    for each entry, so that a simulation requested by several processes at
+    once is only compiled once, and so that entries are not removed while
+    being loaded. On other systems, entries are still written to a temporary
+    file first and then moved into place, so that no process can see a
+    partially written entry.
+    """
+    def __init__(self, path=None, max_size=2**28):
+        if path is None:
+            path = os.path.join(myokit.DIR_USER, 'simulation-cache')
+        self._path = os.path.abspath(os.path.expanduser(path))
+        os.makedirs(self._path, exist_ok=True)
+        self._max_size = int(max_size)
+        self._hits = self._misses = 0
+
+    def clear(self):
+        """
+        Removes all entries not currently in use from the cache.
+        """
+        self._evict(0)
+
+    def _evict(self, max_size):
+        """
+        Removes the least recently used entries until the total size is at
+        most ``max_size``. Entries that are locked by another process are
+        skipped.
+        """
+        entries = []
+        for name in os.listdir(self._path):
+            if name.endswith('.zip'):
+                try:
+                    s = os.stat(os.path.join(self._path, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((s.st_mtime, s.st_size, name[:-4]))
+        entries.sort()
+        size = sum(x[1] for x in entries)
+        for mtime, n, key in entries:
+            if size <= max_size:
+                break
+            with _Lock(self._lock_path(key), block=False) as locked:
+                if locked:
+                    try:
+                        os.remove(self._zip_path(key))
+                        size -= n
+                    except FileNotFoundError:
+                        pass
+
+    def info(self):
+        """
+        Returns a tuple ``(hits, misses, entries, size)``, with the number of
+        cache hits and misses for this object, and the number of entries and
+        their total size on disk.
+        """
+        sizes = [
+            os.path.getsize(os.path.join(self._path, x))
+            for x in os.listdir(self._path) if x.endswith('.zip')]
+        return self._hits, self._misses, len(sizes), sum(sizes)
+
+    @staticmethod
+    def key(model, protocol=None, sensitivities=None):
+        """
+        Returns the key used to store a simulation of ``model``, with the
+        given ``protocol`` (or dict of protocols) and ``sensitivities``.
+
+        The model is included using its code, so that the same model written
+        in a different order gets a different key.
+        """
+        if not isinstance(protocol, dict):
+            protocol = {'pace': protocol}
+        h = hashlib.sha256()
+        for x in (myokit.__version__, sys.version, platform.platform()):
+            h.update(x.encode('utf8') + b'\0')
+        for label in protocol:
+            h.update(f'{label}:{type(protocol[label]).__name__}'.encode())
+            h.update(b'\0')
+        if sensitivities is not None:
+            for xs in sensitivities:
+                h.update(b'\1' + b'\0'.join(str(x).encode() for x in xs))
+        h.update(b'\2' + model.code().encode('utf8'))
+        return h.hexdigest()
+
+    def _lock_path(self, key):
+        return os.path.join(self._path, key + '.lock')
+
+    def simulation(self, model, protocol=None, sensitivities=None):
+        """
+        Returns a :class:`myokit.Simulation` for the given ``model``,
+        ``protocol``, and ``sensitivities``, loading a compiled module from
+        the cache if possible.
+        """
+        key = self.key(model, protocol, sensitivities)
+        path = self._zip_path(key)
+        with _Lock(self._lock_path(key)):
+            if os.path.isfile(path):
+                self._hits += 1
+                os.utime(path)
+                sim = myokit.Simulation.from_path(path)
+                # The stored protocols are those used when compiling
+                if isinstance(protocol, dict):
+                    for label, p in protocol.items():
+                        sim.set_protocol(p, label)
+                else:
+                    sim.set_protocol(protocol)
+                return sim
+
+            # Compile, write to a temporary file, and then move into place
+            self._misses += 1
+            fd, temp = tempfile.mkstemp('.tmp', key, self._path)
+            os.close(fd)
+            try:
+                sim = myokit.Simulation(model, protocol, sensitivities, temp)
+                os.replace(temp, path)
+            finally:
+                if os.path.exists(temp):
+                    os.remove(temp)
+        self._evict(self._max_size)
+        return sim
+
+    def _zip_path(self, key):
+        return os.path.join(self._path, key + '.zip')
+
+
+class _Lock(object):
+    """
+    An exclusive lock on the file at ``path``, used as a context manager that
+    returns ``True`` if the lock was acquired.
+
+    With ``block=False``, the lock is only acquired if no other process holds
+    it. Without ``fcntl``, no locking is performed.
+    """
+    def __init__(self, path, block=True):
+        self._path = path
+        self._block = block
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is None:   # pragma: no cover
+            return True
+        self._file = open(self._path, 'a')
+        flags = fcntl.LOCK_EX if self._block else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._file, flags)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def _worker(path, model, protocol):
+    """
+    Requests a simulation from the cache at ``path``, and returns the number
+    of misses.
+    """
+    cache = SimulationCache(path)
+    cache.simulation(model, protocol)
+    return cache.info()[1]
+
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+    import shutil
+
+    parser = argparse.ArgumentParser(
+        description='Compare compiling simulations with loading from a cache.')
+    parser.add_argument(
+        'model', nargs='?', default='example',
+        help='The model to simulate.')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=4,
+        help='The number of processes requesting a simulation at once.')
+    args = parser.parse_args()
+
+    model, protocol, _ = myokit.load(args.model)
+    b = myokit.tools.Benchmarker()
+    path = tempfile.mkdtemp()
+    try:
+        b.reset()
+        myokit.Simulation(model, protocol)
+        print(f'Simulation():               {b.time():>7.2f} s')
+
+        cache = SimulationCache(path)
+        b.reset()
+        cache.simulation(model, protocol)
+        print(f'Cache miss:                 {b.time():>7.2f} s')
+        b.reset()
+        s = cache.simulation(model, protocol)
+        print(f'Cache hit:                  {b.time():>7.2f} s')
+        s.run(1000)
+
+        # Several processes requesting a new simulation at the same time
+        x = next(v for v in model.variables(deep=True) if v.is_literal())
+        x.set_rhs(x.eval() * 1.1)
+        with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+            b.reset()
+            misses = pool.starmap(
+                _worker, [(path, model, protocol)] * args.workers)
+        print(f'{args.workers} processes at once:       {b.time():>7.2f} s'
+              f' ({sum(misses)} compiled)')
+        hits, misses, entries, size = cache.info()
+        print(f'Cache: {entries} entries, {size / 1024:.0f} KiB')
+    finally:
+        shutil.rmtree(path)
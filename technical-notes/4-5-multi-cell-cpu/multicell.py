@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+#
+# Runs multi-cell simulations on the CPU, with the same interface as
+# myokit.SimulationOpenCL.
+#
+import concurrent.futures
+import os
+
+import myokit
+import myokit.formats.python
+import myokit.lib.hh
+import numpy as np
+
+
+class SimulationCPU(object):
+    """
+    Runs multi-cell simulations on the CPU, using NumPy arrays that hold one
+    variable for all cells at once.
+
+    Accepts the following input arguments:
+
+    ``model``
+        The model to simulate. This model is cloned, so that no changes are
+        made to the given model.
+    ``protocol``
+        An optional pacing protocol, used to stimulate the cells selected with
+        :meth:`set_paced_cells` or :meth:`set_paced_cell_list`.
+    ``ncells``
+        The number of cells. Use a scalar for 1d simulations or a tuple
+        ``(nx, ny)`` for 2d simulations.
+    ``diffusion``
+        Set to ``False`` to disable diffusion currents, e.g. to simulate a
+        population of independent cells with :meth:`set_field`.
+    ``precision``
+        Set to ``myokit.SINGLE_PRECISION`` or ``myokit.DOUBLE_PRECISION``
+        (default).
+    ``rl``
+        Use Rush-Larsen updates instead of forward Euler for any
+        Hodgkin-Huxley gating variables (default ``False``).
+    ``threads``
+        The number of threads to use. Defaults to the number of CPUs.
+    ``block_size``
+        The number of cells updated in one go by a single thread.
+
+    As in :class:`myokit.SimulationOpenCL`, models are solved with a
+    fixed-step forward Euler method, variables can bind to ``time``, ``pace``,
+    and ``diffusion_current``, and the variable labelled
+    ``membrane_potential`` is used to calculate diffusion currents. With
+    ``rl=True``, any states that can be written as ``dot(x) = (x_inf - x) /
+    tau_x`` (see :meth:`myokit.lib.hh.get_inf_and_tau`) are updated with the
+    exact solution for fixed ``x_inf`` and ``tau_x`` instead, which stays
+    stable for much larger step sizes.
+
+    The state is stored in a "struct of arrays" layout, as an array of shape
+    ``(n_states, n_cells)``, and each model equation is evaluated as a single
+    NumPy operation on a block of cells, so that the inner loops run over
+    contiguous memory in compiled (and vectorised) code. Cells are split into
+    blocks of ``block_size``, which keeps the intermediary arrays for one block
+    in the CPU cache, and the blocks are divided over a pool of threads (NumPy
+    releases the global interpreter lock during array operations).
+    """
+    def __init__(self, model, protocol=None, ncells=256, diffusion=True,
+                 precision=myokit.DOUBLE_PRECISION, rl=False, threads=None,
+                 block_size=16384):
+
+        # Clone model, and check bindings
+        model = model.clone()
+        model.validate()
+        if model.time() is None:
+            raise ValueError(
+                'The model must contain a variable bound to time.')
+        self._diffusion = bool(diffusion)
+        for label, var in list(model.bindings()):
+            if label == 'diffusion_current' and self._diffusion:
+                continue
+            if label not in ('time', 'pace'):
+                var.set_binding(None)
+        self._vm = model.label('membrane_potential')
+        if self._vm is None or not self._vm.is_state():
+            raise ValueError(
+                'The model must contain a state labelled'
+                ' "membrane_potential".')
+
+        # Find gating variables for Rush-Larsen updates, as tuples
+        # (index, x_inf, tau_x)
+        self._gates = []
+        if rl:
+            model = myokit.lib.hh.convert_hh_states_to_inf_tau_form(
+                model, self._vm)
+            self._vm = model.get(self._vm.qname())
+            for x in model.states():
+                inf_tau = myokit.lib.hh.get_inf_and_tau(x, self._vm)
+                if inf_tau is not None:
+                    self._gates.append((x.index(), ) + inf_tau)
+        self._model = model
+        if self._diffusion and model.binding('diffusion_current') is None:
+            raise ValueError(
+                'With diffusion enabled, the model must contain a variable'
+                ' bound to "diffusion_current".')
+
+        # Dimensions
+        try:
+            self._dims = (int(ncells), )
+        except TypeError:
+            if len(ncells) != 2:
+                raise ValueError(
+                    'The argument "ncells" must be a scalar or a tuple'
+                    ' (nx, ny).')
+            self._dims = (int(ncells[0]), int(ncells[1]))
+        self._nx = self._dims[0]
+        self._ny = self._dims[1] if len(self._dims) == 2 else 1
+        if self._nx < 1 or self._ny < 1:
+            raise ValueError('The number of cells must be at least 1.')
+        self._n = self._nx * self._ny
+
+        # Precision
+        if precision == myokit.SINGLE_PRECISION:
+            self._dtype = np.float32
+        elif precision == myokit.DOUBLE_PRECISION:
+            self._dtype = np.float64
+        else:
+            raise ValueError('Only single and double precision are supported.')
+        self._precision = precision
+
+        # Threads and blocks
+        self._threads = os.cpu_count() if threads is None else int(threads)
+        self._threads = max(1, self._threads)
+        block_size = max(1, int(block_size))
+        self._blocks = [
+            (i, min(i + block_size, self._n))
+            for i in range(0, self._n, block_size)]
+
+        # State, stored as an array of shape (n_states, n_cells)
+        self._states = list(model.states())
+        self._ivm = self._states.index(self._vm)
+        state = np.array(model.initial_values(True), dtype=self._dtype)
+        self._default_state = np.repeat(state[:, None], self._n, axis=1)
+        self._state = np.array(self._default_state)
+        self._time = 0
+
+        # Literal constants, and fields to replace them
+        self._literals = [
+            x for x in model.variables(deep=True)
+            if x.is_literal() and not x.is_bound()]
+        self._fields = {}
+
+        # Pacing, diffusion, and step size
+        self._paced = np.zeros(self._n, dtype=bool)
+        self.set_paced_cells()
+        self._gx, self._gy = 10, 5
+        self._step_size = 0.005
+        self.set_protocol(protocol)
+
+        # Generate function to evaluate the model for a block of cells
+        self._generate_function()
+
+    def _generate_function(self):
+        """
+        Creates a function that evaluates the model's derivatives for a block
+        of cells, and stores them in ``_dy``.
+
+        Literal constants are passed in as ``_c``, which can contain floats or
+        arrays (for fields). If a dict ``_log`` is given, all local variables
+        are stored in it, so that intermediary variables can be logged.
+
+        The function returns a tuple ``(x_inf, tau_x)`` for every gating
+        variable that uses Rush-Larsen updates.
+        """
+        model = self._model
+        names = {}
+        for i, var in enumerate(model.variables(deep=True)):
+            names[var] = f'_v{i}'
+        names.update({x: f'_y[{i}]' for i, x in enumerate(self._states)})
+
+        def lhs(x):
+            var = x.var()
+            if isinstance(x, myokit.Derivative):
+                return f'_dy[{var.index()}]'
+            return names[var]
+
+        w = myokit.formats.python.NumPyExpressionWriter()
+        w.set_lhs_function(lhs)
+
+        body = ['def _rhs(_c, _t, _pace, _idiff, _y, _dy, _log):']
+        for i, var in enumerate(self._literals):
+            body.append(f'    {names[var]} = _c[{i}]')
+        bound = {'time': '_t', 'pace': '_pace', 'diffusion_current': '_idiff'}
+        for label, var in model.bindings():
+            body.append(f'    {names[var]} = {bound[label]}')
+
+        # Store states as local variables too, so that they can be logged
+        self._local = {}
+        for i, var in enumerate(self._states):
+            self._local[var.qname()] = f'_s{i}'
+            body.append(f'    _s{i} = _y[{i}]')
+
+        for eqs in model.solvable_order().values():
+            for eq in eqs:
+                var = eq.lhs.var()
+                if var.is_bound() or var in self._literals:
+                    continue
+                body.append(f'    {w.ex(eq.lhs)} = {w.ex(eq.rhs)}')
+                if not var.is_state():
+                    self._local[var.qname()] = names[var]
+        for var in self._literals:
+            self._local[var.qname()] = names[var]
+        for label, var in model.bindings():
+            self._local[var.qname()] = names[var]
+        body.append('    if _log is not None:')
+        body.append('        _log.update(locals())')
+        gates = ''.join(
+            f'({names[inf]}, {names[tau]}), ' for i, inf, tau in self._gates)
+        body.append(f'    return ({gates})')
+
+        local = {}
+        exec('\n'.join(body), {'numpy': np}, local)
+        self._rhs = local['_rhs']
+
+    def default_state(self, x=None, y=None):
+        """
+        Returns the default state, as in :meth:`state`.
+        """
+        return self._get(self._default_state, x, y)
+
+    def _diffusion_current(self, idiff):
+        """
+        Calculates the diffusion current for every cell, and stores it in the
+        array ``idiff``.
+        """
+        v = self._state[self._ivm].reshape(self._ny, self._nx)
+        i = idiff.reshape(self._ny, self._nx)
+        i.fill(0)
+        if self._nx > 1:
+            d = self._gx * (v[:, :-1] - v[:, 1:])
+            i[:, :-1] += d
+            i[:, 1:] -= d
+        if self._ny > 1:
+            d = self._gy * (v[:-1] - v[1:])
+            i[:-1] += d
+            i[1:] -= d
+
+    def _get(self, state, x, y):
+        """ Returns (part of) a state array as a list. """
+        if x is None:
+            return list(state.T.ravel())
+        return list(state[:, self._index(x, y)])
+
+    def _index(self, x, y=None):
+        """ Returns the index of cell ``(x, y)`` in the state array. """
+        x = int(x)
+        if x < 0 or x >= self._nx:
+            raise IndexError(f'X-coordinate out of range: {x}.')
+        if len(self._dims) == 1:
+            return x
+        y = int(y)
+        if y < 0 or y >= self._ny:
+            raise IndexError(f'Y-coordinate out of range: {y}.')
+        return x + y * self._nx
+
+    def _log_plan(self, log):
+        """
+        Returns a tuple ``(log, global_keys, cell_keys)``, where ``log`` is a
+        :class:`myokit.DataLog` to store results in, ``global_keys`` is a list
+        of tuples ``(key, qname)`` and ``cell_keys`` is a dict mapping qnames
+        to a list of keys and an array with the logged cells' indices.
+        """
+        time = self._model.time().qname()
+        log = myokit.prepare_log(
+            log, self._model, dims=self._dims, global_vars=[time],
+            if_empty=myokit.LOG_STATE + myokit.LOG_BOUND,
+            allowed_classes=myokit.LOG_STATE + myokit.LOG_BOUND
+            + myokit.LOG_INTER,
+            precision=self._precision)
+
+        global_keys = []
+        cell_keys = {}
+        nd = len(self._dims)
+        for key in log:
+            if key == time:
+                global_keys.append((key, key))
+                continue
+            parts = key.split('.', nd)
+            index = self._index(*parts[:nd])
+            keys, indices = cell_keys.setdefault(parts[nd], ([], []))
+            keys.append(key)
+            indices.append(index)
+        cell_keys = {
+            q: (keys, np.array(indices))
+            for q, (keys, indices) in cell_keys.items()}
+        return log, global_keys, cell_keys
+
+    def pre(self, duration):
+        """
+        Runs a simulation without logging, and updates both the current and
+        the default state.
+
+        As in :meth:`myokit.Simulation.pre`, the simulation time is not
+        changed, and the pacing protocol is restarted from the current time.
+        """
+        time = self._time
+        try:
+            self.run(duration, log=myokit.LOG_NONE)
+        finally:
+            self._time = time
+            self.set_protocol(self._protocol)
+        self._default_state[:] = self._state
+
+    def reset(self):
+        """
+        Resets the time and state to their default values.
+        """
+        self._time = 0
+        self._state[:] = self._default_state
+        self.set_protocol(self._protocol)
+
+    def run(self, duration, log=None, log_interval=1.0):
+        """
+        Runs a simulation and returns the logged results.
+
+        The ``log`` argument can be ``None`` (to log all states and bound
+        variables), a combination of the ``myokit.LOG_STATE``,
+        ``myokit.LOG_BOUND`` and ``myokit.LOG_INTER`` flags, a list of
+        variable names, or an existing :class:`myokit.DataLog`, as in
+        :meth:`myokit.SimulationOpenCL.run`.
+
+        The ``duration`` and ``log_interval`` are rounded to the nearest
+        multiple of the step size. Values are logged at the start of every log
+        interval.
+        """
+        dt = self._step_size
+        steps = int(round(duration / dt))
+        if steps < 0:
+            raise ValueError('Duration cannot be negative.')
+        interval = max(1, int(round(log_interval / dt)))
+        log, global_keys, cell_keys = self._log_plan(log)
+        logged = {q: self._local[q] for q in cell_keys}
+        buffers = {q: np.zeros(self._n, self._dtype) for q in cell_keys}
+        values = {q: [] for q in cell_keys}
+        times = []
+
+        # Constants, as floats or arrays, for each block
+        c = [
+            self._fields.get(x, self._dtype(x.eval())) for x in self._literals]
+        cs = [
+            [x[a:b] if isinstance(x, np.ndarray) else x for x in c]
+            for a, b in self._blocks]
+
+        # Diffusion currents and pacing levels for each block
+        idiff = np.zeros(self._n, self._dtype)
+        idiffs = [
+            idiff[a:b] if self._diffusion else 0 for a, b in self._blocks]
+        paced = self._paced.astype(self._dtype)
+        level = None
+        paces = [0] * len(self._blocks)
+
+        dy = np.empty(self._state.shape, self._dtype)
+
+        def update(i, t, log):
+            """ Updates block ``i``, and optionally logs its variables. """
+            a, b = self._blocks[i]
+            y = self._state[:, a:b]
+            d = dy[:, a:b]
+            out = {} if log else None
+            gates = self._rhs(cs[i], t, paces[i], idiffs[i], y, d, out)
+            if log:
+                for q, name in logged.items():
+                    buffers[q][a:b] = out[name]
+            d *= dt
+            for (j, _, _), (inf, tau) in zip(self._gates, gates):
+                d[j] = (inf - y[j]) * -np.expm1(-dt / tau)
+            y += d
+
+        pool = None
+        if self._threads > 1 and len(self._blocks) > 1:
+            pool = concurrent.futures.ThreadPoolExecutor(self._threads)
+        try:
+            t0 = self._time
+            for step in range(steps):
+                t = t0 + step * dt
+                if self._pacing is not None:
+                    new_level = self._pacing.advance(t)
+                    if new_level != level:
+                        level = new_level
+                        if level == 0:
+                            paces = [0] * len(self._blocks)
+                        else:
+                            pace = paced * level
+                            paces = [pace[a:b] for a, b in self._blocks]
+                if self._diffusion:
+                    self._diffusion_current(idiff)
+                log_now = step % interval == 0
+                if pool is None:
+                    for i in range(len(self._blocks)):
+                        update(i, t, log_now)
+                else:
+                    list(pool.map(
+                        lambda i: update(i, t, log_now),
+                        range(len(self._blocks))))
+                if log_now:
+                    times.append(t)
+                    for q, (keys, indices) in cell_keys.items():
+                        values[q].append(buffers[q][indices])
+                if not np.all(np.isfinite(self._state[self._ivm])):
+                    raise myokit.SimulationError(
+                        f'Non-finite membrane potential at t={t}.')
+            self._time = t0 + steps * dt
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        # Store results
+        for key, q in global_keys:
+            log[key] = np.concatenate((log[key], times))
+        for q, (keys, indices) in cell_keys.items():
+            v = np.array(values[q]).reshape(len(times), len(keys))
+            for j, key in enumerate(keys):
+                log[key] = np.concatenate((log[key], v[:, j]))
+        return log
+
+    def set_conductance(self, gx=10, gy=5):
+        """
+        Sets the cell-to-cell conductances used to calculate the diffusion
+        current, as in :meth:`myokit.SimulationOpenCL.set_conductance`.
+        """
+        self._gx, self._gy = float(gx), float(gy)
+
+    def set_constant(self, var, value):
+        """
+        Changes the value of a literal constant, for all cells that do not
+        have a field set for this variable.
+        """
+        var = self._model.get(var if isinstance(var, str) else var.qname())
+        if var not in self._literals:
+            raise ValueError(f'Not a literal constant: {var.qname()}.')
+        var.set_rhs(float(value))
+
+    def set_default_state(self, state, x=None, y=None):
+        """
+        Changes the default state, as in :meth:`set_state`.
+        """
+        self._set(self._default_state, state, x, y)
+
+    def set_field(self, var, values):
+        """
+        Replaces a literal constant with a different value for each cell,
+        given as an array of shape ``(ny, nx)`` (or ``nx`` for 1d
+        simulations).
+        """
+        var = self._model.get(var if isinstance(var, str) else var.qname())
+        if var not in self._literals:
+            raise ValueError(f'Not a literal constant: {var.qname()}.')
+        values = np.array(values, dtype=self._dtype)
+        if values.shape != tuple(reversed(self._dims)):
+            raise ValueError(
+                'The field must have dimensions '
+                f'{tuple(reversed(self._dims))}.')
+        self._fields[var] = values.ravel()
+
+    def set_paced_cells(self, nx=5, ny=5, x=0, y=0):
+        """
+        Selects a rectangle of cells to pace, as in
+        :meth:`myokit.SimulationOpenCL.set_paced_cells`.
+        """
+        def span(n, offset, size):
+            offset = offset + size if offset < 0 else offset
+            lo, hi = (offset + n, offset) if n < 0 else (offset, offset + n)
+            return max(0, lo), min(size, hi)
+
+        x0, x1 = span(int(nx), int(x), self._nx)
+        y0, y1 = (0, 1) if len(self._dims) == 1 else span(
+            int(ny), int(y), self._ny)
+        paced = self._paced.reshape(self._ny, self._nx)
+        paced.fill(False)
+        paced[y0:y1, x0:x1] = True
+
+    def set_paced_cell_list(self, cells):
+        """
+        Selects the cells to pace, given as a list of indices ``x`` (1d) or
+        tuples ``(x, y)`` (2d).
+        """
+        self._paced.fill(False)
+        for cell in cells:
+            if len(self._dims) == 1:
+                self._paced[self._index(cell)] = True
+            else:
+                self._paced[self._index(*cell)] = True
+
+    def set_protocol(self, protocol=None):
+        """
+        Changes the pacing protocol.
+        """
+        self._protocol = protocol
+        self._pacing = None
+        if protocol is not None:
+            self._pacing = myokit.PacingSystem(protocol)
+            self._pacing.advance(self._time)
+
+    def _set(self, target, state, x, y):
+        """ Updates a state array, see :meth:`set_state`. """
+        state = np.array(state, dtype=self._dtype)
+        ns = len(self._states)
+        if x is not None:
+            if state.shape != (ns, ):
+                raise ValueError(f'The state must have length {ns}.')
+            target[:, self._index(x, y)] = state
+        elif state.shape == (ns, ):
+            target[:] = state[:, None]
+        elif state.shape == (ns * self._n, ):
+            target[:] = state.reshape(self._n, ns).T
+        else:
+            raise ValueError(
+                f'The state must have length {ns} or {ns * self._n}.')
+
+    def set_state(self, state, x=None, y=None):
+        """
+        Changes the current state.
+
+        The ``state`` can be a single state, which is used for all cells, or
+        for cell ``(x, y)`` if given, or a concatenation of the states of all
+        cells (with ``x`` changing first), as in
+        :meth:`myokit.SimulationOpenCL.set_state`.
+        """
+        self._set(self._state, state, x, y)
+
+    def set_step_size(self, step_size=0.005):
+        """
+        Sets the step size used by the forward Euler and Rush-Larsen updates.
+        """
+        step_size = float(step_size)
+        if step_size <= 0:
+            raise ValueError('The step size must be greater than zero.')
+        self._step_size = step_size
+
+    def set_time(self, time=0):
+        """
+        Changes the simulation time.
+        """
+        self._time = float(time)
+        self.set_protocol(self._protocol)
+
+    def shape(self):
+        """
+        Returns the shape of the grid of cells, as ``(ny, nx)`` for 2d
+        simulations or ``nx`` for 1d simulations.
+        """
+        return self._nx if len(self._dims) == 1 else (self._ny, self._nx)
+
+    def state(self, x=None, y=None):
+        """
+        Returns the current state, as a list of ``n_states * n_cells`` values
+        (with ``x`` changing first), or the state of cell ``(x, y)`` if given.
+        """
+        return self._get(self._state, x, y)
+
+    def time(self):
+        """
+        Returns the current simulation time.
+        """
+        return self._time
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Run multi-cell simulations on the CPU, for increasing'
+                    ' numbers of cells.')
+    parser.add_argument(
+        'model', nargs='?', default='example',
+        help='The model to simulate.')
+    parser.add_argument(
+        '-c', '--cells', type=int, nargs='+',
+        default=[100, 1000, 10000, 100000, 1000000],
+        help='The numbers of cells to test.')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=1,
+        help='The simulated time (ms).')
+    parser.add_argument(
+        '-l', '--loop', type=int, default=1000,
+        help='The largest number of cells to simulate with a loop of'
+             ' single-cell simulations.')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=None,
+        help='The number of threads to use.')
+    args = parser.parse_args()
+
+    # Pace the first 10 cells, starting at t=0.5ms
+    model = myokit.load_model(args.model)
+    protocol = myokit.pacing.blocktrain(1000, 0.5, offset=0.5)
+    b = myokit.tools.Benchmarker()
+    print(f'{os.cpu_count()} CPUs, {args.duration} ms simulated,'
+          f' step size 0.005 ms')
+    print(f'{"Cells":>9}{"Cable":>12}{"Population":>12}'
+          f'{"Loop":>12}{"Cells*steps/s":>15}')
+    for n in args.cells:
+        times = []
+        for diffusion in (True, False):
+            s = SimulationCPU(
+                model, protocol, n, diffusion=diffusion, threads=args.threads)
+            s.set_paced_cells(10)
+            b.reset()
+            s.run(args.duration, log=myokit.LOG_NONE)
+            times.append(b.time())
+
+        # Single-cell simulations with CVODES, one for each cell
+        loop = '-'
+        if n <= args.loop:
+            s = myokit.Simulation(model, protocol)
+            b.reset()
+            for i in range(n):
+                s.reset()
+                s.run(args.duration, log=myokit.LOG_NONE)
+            loop = f'{b.time():.2f} s'
+        rate = n * args.duration / 0.005 / times[1]
+        print(f'{n:>9}{times[0]:>10.2f} s{times[1]:>10.2f} s{loop:>12}'
+              f'{rate:>15.3g}')
@@ -0,0 +1,211 @@
+<?
+# population.c
+#
+# Advances a population of cells in lockstep, with fixed-step forward Euler
+# and Rush-Larsen updates.
+#
+# Required variables
+# -----------------------------------------------------------------------------
+# module_name  A module name
+# model        A myokit model, with unique names set
+# parameters   A list of literal variables that can be set for each cell
+# gates        A dict mapping states to (x_inf, tau_x) for Rush-Larsen updates
+# lookup       A dict mapping variables to lookup table columns
+# rl_lookup    A dict mapping gates to two lookup table columns (a, b), so that
+#              the Rush-Larsen update is x = a + b * x
+# skip         A set of variables that are not evaluated
+# table        None, or a tuple (v, vmin, dv, rows, columns)
+# log          A list of variables to log
+# writer       An expression writer for the selected precision
+# precision    myokit.SINGLE_PRECISION or myokit.DOUBLE_PRECISION
+# block_size   The number of cells to update in one go
+# -----------------------------------------------------------------------------
+#
+import myokit
+
+w = writer
+tab = '    '
+
+
+def v(var):
+    if isinstance(var, myokit.Derivative):
+        return 'D_' + var.var().uname()
+    if isinstance(var, myokit.Name):
+        var = var.var()
+    if var.is_state():
+        return 'S_' + var.uname()
+    return 'V_' + var.uname()
+
+
+w.set_lhs_function(v)
+states = list(model.states())
+time = model.time()
+pace = model.binding('pace')
+
+
+def body(logging):
+    # Read states and parameters
+    for i, x in enumerate(states):
+        print(3 * tab + f'const Real {v(x)} = y[{i} * n + i];')
+    for i, x in enumerate(parameters):
+        print(3 * tab + f'const Real {v(x)} = p[{i} * n + i];')
+    print(3 * tab + f'const Real {v(time)} = t;')
+    if pace is not None:
+        print(3 * tab + f'const Real {v(pace)} = level;')
+
+    # Interpolate from the lookup table
+    if table is not None:
+        vm, vmin, dv, rows, columns = table
+        print(3 * tab + f'Real _f = ({v(vm)} - {w.ex(myokit.Number(vmin))})'
+                        f' * {w.ex(myokit.Number(1 / dv))};')
+        print(3 * tab + f'_f = (_f < 0) ? 0 : ((_f > {rows - 2}) ?'
+                        f' {rows - 2} : _f);')
+        print(3 * tab + 'const int _k = (int)_f;')
+        print(3 * tab + 'const Real _w = _f - (Real)_k;')
+        # Indexing with an offset, not a pointer, lets the loop vectorise
+        print(3 * tab + f'const int _r = _k * {columns};')
+
+        def interpolate(c):
+            a, b = f'table[_r + {c}]', f'table[_r + {columns + c}]'
+            return f'{a} + _w * ({b} - {a})'
+
+        for x, c in lookup.items():
+            print(3 * tab + f'const Real {v(x)} = {interpolate(c)};')
+        for x, (a, b) in rl_lookup.items():
+            print(3 * tab + f'const Real A_{x.uname()} = {interpolate(a)};')
+            print(3 * tab + f'const Real B_{x.uname()} = {interpolate(b)};')
+
+    # Evaluate all other equations, in a solvable order
+    for eqs in model.solvable_order().values():
+        for eq in eqs:
+            var = eq.lhs.var()
+            if var.is_bound() or var in parameters or var in lookup:
+                continue
+            if var in skip or var in rl_lookup:
+                continue
+            print(3 * tab + f'const Real {w.eq(eq)};')
+
+    # Log
+    if logging:
+        for k, x in enumerate(log):
+            print(3 * tab + f'out[({k} * n_log + j) * n + i] = {v(x)};')
+
+    # Update
+    for i, x in enumerate(states):
+        if x in rl_lookup:
+            print(3 * tab + f'y[{i} * n + i] = A_{x.uname()}'
+                            f' + B_{x.uname()} * {v(x)};')
+        elif x in gates:
+            inf, tau = (v(z) for z in gates[x])
+            print(3 * tab + f'y[{i} * n + i] = {inf} + ({v(x)} - {inf})'
+                            f' * exp(-dt / {tau});')
+        else:
+            print(3 * tab + f'y[{i} * n + i] = {v(x)} + dt * {v(x.lhs())};')
+?>
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <tgmath.h>
+
+/* Floating point type for states, parameters, and logged values */
+<?
+print('typedef float Real;' if precision == myokit.SINGLE_PRECISION
+      else 'typedef double Real;')
+?>
+#define BLOCK_SIZE <?= block_size ?>
+
+/*
+ * Advances cells i0 to i1 (exclusive) from a population of n cells.
+ *
+ * The state y and parameters p are stored as (n_states, n) and
+ * (n_parameters, n) arrays. The pacing level for each step is given in pace.
+ * If used, the lookup table is stored as a (rows, columns) array.
+ * Logged variables are stored at every log_every-th step in out, an array of
+ * shape (n_logged, n_log, n).
+ *
+ * Cells are updated in blocks, so that each block's state stays in the cache
+ * during all steps, and the cells in each block are updated with SIMD
+ * instructions.
+ */
+static void
+advance(const long i0, const long i1, const long n, const long n_steps,
+        const double t0, const Real dt, const long log_every, Real* y,
+        const Real* p, const double* pace, Real* out, const long n_log,
+        const Real* table)
+{
+    long b, b1, s, i, j;
+    Real t, level;
+    for (b = i0; b < i1; b += BLOCK_SIZE) {
+        b1 = (b + BLOCK_SIZE < i1) ? b + BLOCK_SIZE : i1;
+        for (s = 0; s < n_steps; s++) {
+            t = (Real)(t0 + s * (double)dt);
+            level = (Real)pace[s];
+            if (log_every > 0 && s % log_every == 0) {
+                j = s / log_every;
+                #pragma omp simd
+                for (i = b; i < b1; i++) {
+<?
+body(True)
+?>
+                }
+            } else {
+                #pragma omp simd
+                for (i = b; i < b1; i++) {
+<?
+body(False)
+?>
+                }
+            }
+        }
+    }
+}
+
+/*
+ * Python wrapper around advance(). Releases the global interpreter lock, so
+ * that several threads can update different cells at once.
+ */
+static PyObject*
+run(PyObject* self, PyObject* args)
+{
+    long i0, i1, n, n_steps, log_every, n_log;
+    double t0, dt;
+    Py_buffer y, p, pace, out, table;
+
+    if (!PyArg_ParseTuple(args, "llllddlw*y*y*w*ly*", &i0, &i1, &n, &n_steps,
+                          &t0, &dt, &log_every, &y, &p, &pace, &out, &n_log,
+                          &table))
+    {
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    advance(i0, i1, n, n_steps, t0, (Real)dt, log_every, (Real*)y.buf,
+            (const Real*)p.buf, (const double*)pace.buf, (Real*)out.buf,
+            n_log, (const Real*)table.buf);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&y);
+    PyBuffer_Release(&p);
+    PyBuffer_Release(&pace);
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&table);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef SimMethods[] = {
+    {"run", run, METH_VARARGS, "Advances a range of cells."},
+    {NULL},
+};
+
+static struct PyModuleDef moduledef = {
+    PyModuleDef_HEAD_INIT,
+    "<?= module_name ?>",       /* m_name */
+    "Generated population simulation module",   /* m_doc */
+    -1,                         /* m_size */
+    SimMethods,                 /* m_methods */
+    NULL,                       /* m_reload */
+    NULL,                       /* m_traverse */
+    NULL,                       /* m_clear */
+    NULL,                       /* m_free */
+};
+
+PyMODINIT_FUNC PyInit_<?= module_name ?>(void) {
+    return PyModule_Create(&moduledef);
+}
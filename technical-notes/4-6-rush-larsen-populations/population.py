@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+#
+# Simulates populations of cells with different parameters, using a compiled
+# fixed-step Rush-Larsen method.
+#
+import concurrent.futures
+import os
+import platform
+
+import myokit
+import myokit.formats.ansic
+import myokit.formats.opencl
+import myokit.formats.python
+import myokit.lib.hh
+import numpy as np
+
+# Location of C template
+SOURCE_FILE = os.path.join(os.path.dirname(__file__), 'population.c')
+
+
+class PopulationSimulation(myokit.CModule):
+    """
+    Simulates a population of cells in lockstep, with a different parameter
+    set for every cell, using a fixed step size.
+
+    Accepts the following input arguments:
+
+    ``model``
+        The model to simulate.
+    ``protocol``
+        An optional pacing protocol, used for all cells.
+    ``parameters``
+        A list of (literal constant) variables to vary.
+    ``log``
+        A list of variables to log. If not given, the variable labelled
+        ``membrane_potential`` is logged.
+    ``rl``
+        Use Rush-Larsen updates for any Hodgkin-Huxley gating variables
+        (default ``True``). Other states are updated with forward Euler.
+    ``table``
+        An optional tuple ``(v_min, v_max, dv)``, to use a lookup table for
+        all variables that depend only on the membrane potential.
+    ``precision``
+        Set to ``myokit.SINGLE_PRECISION`` or ``myokit.DOUBLE_PRECISION``
+        (default).
+    ``threads``
+        The number of threads to use. Defaults to the number of CPUs.
+
+    With ``rl=True``, any states that can be written as ``dot(x) = (x_inf - x)
+    / tau_x`` (see :meth:`myokit.lib.hh.get_inf_and_tau`) are updated with
+    ``x_inf + (x - x_inf) * exp(-dt / tau_x)``, which is exact if ``x_inf``
+    and ``tau_x`` are constant during a step, and stable for any step size.
+
+    The model is compiled into a C module that stores the states and
+    parameters in a "struct of arrays" layout, with one contiguous array per
+    state or parameter. Each step updates a block of cells in a single loop
+    that the compiler vectorises with SIMD instructions, and every block is
+    advanced through all steps before moving to the next, so that its state
+    stays in the cache. Blocks are divided over ``threads`` threads.
+
+    With a lookup ``table``, every variable that depends on the membrane
+    potential and on constants (but not on the parameters) is calculated once
+    for every ``dv`` between ``v_min`` and ``v_max``, and found by linear
+    interpolation during the simulation. For gating variables whose
+    ``x_inf`` and ``tau_x`` can be tabulated, the Rush-Larsen update is
+    rewritten as ``x = a + b * x`` and ``a`` and ``b`` are tabulated instead,
+    so that no exponentials need to be calculated for these gates at all.
+    Membrane potentials outside the table range use the nearest value in the
+    table.
+
+    The pacing level is sampled at the start of every step, so that events
+    shorter than a step may be missed, and event times are effectively rounded
+    up to a multiple of the step size.
+    """
+    _index = 0  # Unique id for the generated module
+
+    def __init__(self, model, protocol=None, parameters=None, log=None,
+                 rl=True, table=None, precision=myokit.DOUBLE_PRECISION,
+                 threads=None):
+        super().__init__()
+
+        # Clone model, remove unsupported bindings
+        model.validate()
+        model = model.clone()
+        if model.time() is None:
+            raise ValueError(
+                'The model must contain a variable bound to time.')
+        for label, var in list(model.bindings()):
+            if label not in ('time', 'pace'):
+                var.set_binding(None)
+        self._reference_model = model.clone()
+        self._protocol = protocol
+
+        # Convert to inf-tau form and find gating variables
+        vm = model.label('membrane_potential')
+        gates = {}
+        if rl:
+            if vm is None:
+                raise ValueError(
+                    'Rush-Larsen updates require a variable labelled'
+                    ' "membrane_potential".')
+            model = myokit.lib.hh.convert_hh_states_to_inf_tau_form(model, vm)
+            vm = model.get(vm.qname())
+            for x in model.states():
+                inf_tau = myokit.lib.hh.get_inf_and_tau(x, vm)
+                if inf_tau is not None:
+                    gates[x] = inf_tau
+        self._gates = [x.qname() for x in gates]
+        self._model = model
+
+        # Parameters and logged variables
+        self._parameters = [
+            model.get(x if isinstance(x, str) else x.qname())
+            for x in (parameters or [])]
+        for x in self._parameters:
+            if not x.is_literal():
+                raise ValueError(f'Not a literal constant: {x.qname()}.')
+        if log is None:
+            if vm is None:
+                raise ValueError(
+                    'A log must be given, or a variable must be labelled'
+                    ' "membrane_potential".')
+            log = [vm]
+        self._log = [model.get(x if isinstance(x, str) else x.qname())
+                     for x in log]
+        for x in self._log:
+            if x.is_constant() or x.is_bound():
+                raise ValueError(f'Cannot log {x.qname()}.')
+
+        # Precision
+        if precision == myokit.SINGLE_PRECISION:
+            self._dtype = np.float32
+            writer = myokit.formats.opencl.OpenCLExpressionWriter(
+                precision, native_math=False)
+            carg = ['-fsingle-precision-constant']
+        elif precision == myokit.DOUBLE_PRECISION:
+            self._dtype = np.float64
+            writer = myokit.formats.ansic.AnsiCExpressionWriter()
+            carg = []
+        else:
+            raise ValueError('Only single and double precision are supported.')
+
+        # Default parameters and state
+        self._default_parameters = np.array(
+            [x.eval() for x in self._parameters])
+        self._default_state = np.array(model.initial_values(True))
+        self._step_size = 0.01
+        self._table = None
+        self._table_v = None
+        self._threads = max(1, os.cpu_count() if threads is None else threads)
+
+        # Create lookup table function
+        lookup, rl_lookup, skip, table_args = {}, {}, set(), None
+        if table is not None:
+            if vm is None or not vm.is_state():
+                raise ValueError(
+                    'Lookup tables require a state labelled'
+                    ' "membrane_potential".')
+            v_min, v_max, dv = (float(x) for x in table)
+            if v_max <= v_min or dv <= 0:
+                raise ValueError('Invalid table range.')
+            self._table_v = np.arange(v_min, v_max + dv / 2, dv)
+            lookup, rl_lookup, skip = self._generate_table_function(vm, gates)
+            columns = len(lookup) + 2 * len(rl_lookup)
+            table_args = (vm, v_min, dv, len(self._table_v), columns)
+
+        # Compile. Fast maths lets the compiler use vectorised versions of
+        # exp() and other functions, and treat the update loops as SIMD loops.
+        model.reserve_unique_names(*myokit.formats.ansic.keywords)
+        model.create_unique_names()
+        PopulationSimulation._index += 1
+        module_name = 'population_' + str(PopulationSimulation._index)
+        module_name += '_' + str(myokit.pid_hash())
+        args = {
+            'module_name': module_name,
+            'model': model,
+            'parameters': self._parameters,
+            'gates': gates,
+            'lookup': lookup,
+            'rl_lookup': rl_lookup,
+            'skip': skip,
+            'table': table_args,
+            'log': self._log,
+            'writer': writer,
+            'precision': precision,
+            'block_size': 256,
+        }
+        # The compiler flags are for GCC (and Clang). On Windows, the module
+        # is compiled with the default flags, and will not be vectorised.
+        if platform.system() == 'Windows':
+            libs, carg = [], []
+        else:
+            libs = ['m']
+            carg += ['-O3', '-ffast-math', '-fopenmp-simd', '-march=native']
+        self._ext = self._compile(
+            module_name, SOURCE_FILE, args, libs, carg=carg)
+
+    def default_parameters(self):
+        """
+        Returns the model's default parameter values.
+        """
+        return np.array(self._default_parameters)
+
+    def default_state(self):
+        """
+        Returns the model's default state.
+        """
+        return np.array(self._default_state)
+
+    def error(self, parameters, duration, log_interval=1.0, state=None,
+              cells=10, tolerance=1e-8):
+        """
+        Compares the results of :meth:`run` with a :class:`myokit.Simulation`
+        using CVODES, for ``cells`` evenly spaced parameter sets from
+        ``parameters``.
+
+        Returns a tuple ``(indices, errors)``, where ``indices`` are the
+        selected parameter sets and ``errors`` is an array of shape
+        ``(len(indices), n_logged)``, containing the root-mean-square
+        difference for each logged variable.
+
+        CVODES is run with absolute and relative tolerance ``tolerance``.
+        """
+        parameters = self._check_parameters(parameters)
+        indices = np.unique(np.linspace(
+            0, len(parameters) - 1, min(cells, len(parameters))).astype(int))
+        state = self._check_state(state, len(parameters))[indices]
+        parameters = parameters[indices]
+        log, _ = self.run(parameters, duration, log_interval, state)
+        times = log[self._model.time().qname()]
+
+        s = myokit.Simulation(self._reference_model, self._protocol)
+        s.set_tolerance(tolerance, tolerance)
+        names = [x.qname() for x in self._log]
+        errors = np.zeros((len(indices), len(names)))
+        for i, (p, x) in enumerate(zip(parameters, state)):
+            s.reset()
+            s.set_state(x)
+            for var, value in zip(self._parameters, p):
+                s.set_constant(var.qname(), value)
+            d = s.run(duration, log=names, log_times=times)
+            for k, name in enumerate(names):
+                e = log[name][i] - np.asarray(d[name])
+                errors[i, k] = np.sqrt(np.mean(e**2))
+        return indices, errors
+
+    def _check_parameters(self, parameters):
+        """ Returns ``parameters`` as an array of shape ``(N, P)``. """
+        parameters = np.array(parameters, dtype=float, ndmin=2)
+        if parameters.shape[1] != len(self._parameters):
+            raise ValueError(
+                f'Expecting {len(self._parameters)} parameters per cell.')
+        return parameters
+
+    def _check_state(self, state, n):
+        """ Returns ``state`` as an array of shape ``(N, n_states)``. """
+        if state is None:
+            state = self._default_state
+        state = np.array(state, dtype=float)
+        if state.shape == self._default_state.shape:
+            state = np.repeat(state[None, :], n, axis=0)
+        if state.shape != (n, len(self._default_state)):
+            raise ValueError(
+                f'The state must have shape ({n}, {len(self._default_state)})'
+                f' or ({len(self._default_state)}, ).')
+        return state
+
+    def _generate_table_function(self, vm, gates):
+        """
+        Finds the variables that depend only on ``vm`` and on constants other
+        than the parameters, and creates a function that evaluates the ones
+        needed by the rest of the model over a range of voltages.
+
+        Returns a tuple ``(lookup, rl_lookup, skip)``, where ``lookup`` maps
+        tabulated variables to columns, ``rl_lookup`` maps gates to two
+        columns ``(a, b)`` for the update ``x = a + b * x``, and ``skip``
+        contains all variables that depend only on ``vm``.
+        """
+        model = self._model
+
+        # Classify variables as constant (0), depending on vm and constants
+        # only (1), or other (2).
+        kinds = {}
+
+        def kind(var):
+            try:
+                return kinds[var]
+            except KeyError:
+                pass
+            if var is vm:
+                k = 1
+            elif var.is_state() or var.is_bound() or var in self._parameters:
+                k = 2
+            else:
+                k = 0
+                for ref in var.rhs().references():
+                    if isinstance(ref, myokit.Derivative):
+                        k = 2
+                    else:
+                        k = max(k, kind(ref.var()))
+            kinds[var] = k
+            return k
+
+        variables = list(model.variables(deep=True))
+        skip = set(x for x in variables if x is not vm and kind(x) == 1)
+
+        # Gates with a tabulated x_inf and tau_x are updated with x = a + b x,
+        # unless their derivative is used elsewhere.
+        derivatives = set()
+        for var in variables:
+            if var.rhs() is not None:
+                derivatives.update(
+                    ref.var() for ref in var.rhs().references()
+                    if isinstance(ref, myokit.Derivative))
+        rl_gates = [
+            x for x, (inf, tau) in gates.items()
+            if inf in skip and tau in skip and x not in derivatives]
+
+        # Find the tabulated variables needed by the remaining equations
+        needed = set(x for x in self._log if x in skip)
+        for var in variables:
+            if var in rl_gates or var in skip or var.rhs() is None:
+                continue
+            if kind(var) == 2 and not var.is_bound():
+                needed.update(
+                    ref.var() for ref in var.rhs().references()
+                    if ref.var() in skip)
+        for x, (inf, tau) in gates.items():
+            if x not in rl_gates:
+                needed.update(y for y in (inf, tau) if y in skip)
+        needed = [x for x in variables if x in needed]
+
+        # Create a function that evaluates all columns
+        names = {x: f'_v{i}' for i, x in enumerate(variables)}
+        names[vm] = '_v'
+        w = myokit.formats.python.NumPyExpressionWriter()
+        w.set_lhs_function(lambda x: names[x.var()])
+        body = ['def _table(_v, _dt):']
+        for eqs in model.solvable_order().values():
+            for eq in eqs:
+                var = eq.lhs.var()
+                if kind(var) < 2 and var is not vm:
+                    body.append(f'    {names[var]} = {w.ex(eq.rhs)}')
+        columns = [names[x] for x in needed]
+        for x in rl_gates:
+            inf, tau = names[gates[x][0]], names[gates[x][1]]
+            columns.append(f'-{inf} * numpy.expm1(-_dt / {tau})')
+            columns.append(f'numpy.exp(-_dt / {tau})')
+        body.append(f'    return [{", ".join(columns)}]')
+        local = {}
+        exec('\n'.join(body), {'numpy': np}, local)
+        self._table_function = local['_table']
+
+        lookup = {x: i for i, x in enumerate(needed)}
+        rl_lookup = {
+            x: (len(needed) + 2 * i, len(needed) + 2 * i + 1)
+            for i, x in enumerate(rl_gates)}
+        return lookup, rl_lookup, skip
+
+    def _get_table(self):
+        """
+        Returns the lookup table for the current step size, as an array of
+        shape ``(rows, columns)``, or a dummy array if no table is used.
+        """
+        if self._table_v is None:
+            return np.zeros(1, dtype=self._dtype)
+        if self._table is None or self._table[0] != self._step_size:
+            with np.errstate(all='ignore'):
+                columns = self._table_function(
+                    self._table_v, self._step_size)
+            table = np.empty(
+                (len(self._table_v), len(columns)), dtype=self._dtype)
+            for i, c in enumerate(columns):
+                table[:, i] = c
+            self._table = (self._step_size, table)
+        return self._table[1]
+
+    def gates(self):
+        """
+        Returns the names of the states updated with Rush-Larsen.
+        """
+        return list(self._gates)
+
+    def run(self, parameters, duration, log_interval=1.0, state=None):
+        """
+        Simulates a cell for every parameter set in ``parameters`` (an array
+        of shape ``(N, P)``), for the given ``duration``.
+
+        Each cell starts from ``state`` (a single state, or an array of shape
+        ``(N, n_states)``) or from the model's initial state if not given, and
+        all simulations start at ``t=0``. The ``duration`` and
+        ``log_interval`` are rounded to the nearest multiple of the step size.
+
+        Returns a tuple ``(log, state)``, where ``log`` is a dict that maps
+        the time variable's name to an array of logged times, and each logged
+        variable's name to an array of shape ``(N, n_times)``, and where
+        ``state`` is an array of shape ``(N, n_states)`` with the final states.
+        """
+        parameters = self._check_parameters(parameters)
+        n = len(parameters)
+        state = self._check_state(state, n)
+        dt = self._step_size
+        steps = int(round(duration / dt))
+        if steps < 0:
+            raise ValueError('Duration cannot be negative.')
+        every = max(1, int(round(log_interval / dt)))
+        n_log = (steps + every - 1) // every
+
+        # Pacing levels, at the start of each step
+        times = np.arange(steps) * dt
+        pace = np.zeros(steps)
+        if self._protocol is not None and steps:
+            pace[:] = self._protocol.value_at_times(times)
+
+        # Arrays in struct-of-arrays layout
+        y = np.ascontiguousarray(state.T, dtype=self._dtype)
+        p = np.ascontiguousarray(parameters.T, dtype=self._dtype)
+        out = np.zeros((len(self._log), n_log, n), dtype=self._dtype)
+
+        # Divide cells over threads, in multiples of the block size
+        size = -(-n // self._threads)
+        size = -(-size // 256) * 256
+        ranges = [(i, min(i + size, n)) for i in range(0, n, size)]
+        args = (n, steps, 0.0, dt, every, y, p, pace, out, n_log,
+                self._get_table())
+        if len(ranges) > 1:
+            with concurrent.futures.ThreadPoolExecutor(len(ranges)) as pool:
+                list(pool.map(lambda r: self._ext.run(*r, *args), ranges))
+        elif ranges:
+            self._ext.run(*ranges[0], *args)
+
+        log = {self._model.time().qname(): times[::every]}
+        for x, values in zip(self._log, out):
+            log[x.qname()] = values.T
+        return log, y.T.astype(float)
+
+    def set_step_size(self, step_size=0.01):
+        """
+        Sets the step size used by the forward Euler and Rush-Larsen updates.
+        """
+        step_size = float(step_size)
+        if step_size <= 0:
+            raise ValueError('The step size must be greater than zero.')
+        self._step_size = step_size
+
+    def step_size(self):
+        """
+        Returns the step size.
+        """
+        return self._step_size
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Simulate a population of cells with random conductances,'
+                    ' and compare with a loop of single-cell simulations.')
+    parser.add_argument(
+        'model', nargs='?', default='../../examples/models/c/grandi-2011.mmt',
+        help='The model to simulate.')
+    parser.add_argument(
+        '-c', '--cells', type=int, default=1000,
+        help='The number of cells in the population.')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=1000,
+        help='The simulated time (ms).')
+    parser.add_argument(
+        '-l', '--loop', type=int, default=100,
+        help='The number of cells to simulate with a loop of single-cell'
+             ' simulations, to estimate the time for the whole population.')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=None,
+        help='The number of threads to use.')
+    args = parser.parse_args()
+
+    # Load model, or use the example model if not found
+    path = args.model if os.path.isfile(args.model) else 'example'
+    model = myokit.load_model(path)
+    vm = model.label('membrane_potential').qname()
+    protocol = myokit.pacing.blocktrain(1000, 0.5, offset=20)
+
+    # Vary all literal conductances with a log-normal scaling
+    parameters = [
+        x for x in model.variables(const=True, deep=True)
+        if x.is_literal() and x.name().lower().startswith('g')]
+    defaults = np.array([x.eval() for x in parameters])
+    rng = np.random.default_rng(1)
+    values = defaults * rng.lognormal(
+        0, 0.2, size=(args.cells, len(parameters)))
+    print(f'Model {os.path.basename(path)}, {os.cpu_count()} CPUs,'
+          f' {args.cells} cells, {args.duration} ms simulated,'
+          f' {len(parameters)} parameters')
+
+    # Single-cell simulations with CVODES, timed for the first few cells
+    b = myokit.tools.Benchmarker()
+    s = myokit.Simulation(model, protocol)
+    n = min(args.loop, args.cells)
+    b.reset()
+    for p in values[:n]:
+        s.reset()
+        for var, value in zip(parameters, p):
+            s.set_constant(var.qname(), value)
+        s.run(args.duration, log=[vm], log_interval=1)
+    loop = b.time() * args.cells / n
+    print(f'{"Method":<16}{"dt (ms)":>8}{"Time":>11}{"Speed-up":>10}'
+          f'{"Max RMSE (mV)":>15}')
+    print(f'{"CVODES loop":<16}{"-":>8}{loop:>9.2f} s{1:>10.1f}{"-":>15}')
+
+    # Population simulations
+    double, single = myokit.DOUBLE_PRECISION, myokit.SINGLE_PRECISION
+    table = (-100, 60, 0.01)
+    tests = [
+        ('Euler', False, None, double, [0.005, 0.01]),
+        ('RL', True, None, double, [0.01, 0.05, 0.1]),
+        ('RL + table', True, table, double, [0.01, 0.05, 0.1]),
+        ('RL + table, f32', True, table, single, [0.05, 0.1]),
+    ]
+    for name, rl, tab, precision, step_sizes in tests:
+        s = PopulationSimulation(
+            model, protocol, parameters, rl=rl, table=tab,
+            precision=precision, threads=args.threads)
+        for dt in step_sizes:
+            s.set_step_size(dt)
+            b.reset()
+            s.run(values, args.duration)
+            t = b.time()
+            _, errors = s.error(values, args.duration)
+            print(f'{name:<16}{dt:>8}{t:>9.2f} s{loop / t:>10.1f}'
+                  f'{np.max(errors):>15.3g}')
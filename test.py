@@ -2,10 +2,20 @@
 #
 # Tests all notebooks
 #
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import json
 import os
 import re
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import warnings
 
 import lxml.etree
@@ -16,16 +26,87 @@ import requests
 # Natural sort regex
 _natural_sort_regex = re.compile(r'([0-9]+)')
 
-# Don't check links twice
-_checked_links = {}
-
-
-def test_notebooks(links=False):
+# HTTP responses (or errors) that count as a working remote link
+_ok_responses = [200, 301, 302, 'ssl-error']
+
+# Directory to cache converted notebooks and test results in
+_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '.test-cache')
+_cache_lock = threading.Lock()
+
+# Notebook subprocesses that are currently running. Each runs in its own
+# session (on POSIX), so that it doesn't receive Ctrl+C from the terminal.
+_running = set()
+_running_lock = threading.Lock()
+
+# Regex to find string literals, which may refer to model or data files
+_string_regex = re.compile(r'''['"]([^'"\n]+)['"]''')
+
+# Regex to find the start of each cell in a converted notebook
+_cell_regex = re.compile(r'^# In\[[^\]]*\]:[ \t]*$', re.MULTILINE)
+
+# Code to run a notebook's cells in a subprocess, while timing every cell.
+# Takes the paths of a JSON file with a list of cells, and a JSON file to
+# write the timings to, as arguments.
+_runner = '''
+import json as _json
+import resource as _resource
+import sys as _sys
+import time as _time
+
+
+def _usage():
+    s = _resource.getrusage(_resource.RUSAGE_SELF)
+    c = _resource.getrusage(_resource.RUSAGE_CHILDREN)
+    rss = max(s.ru_maxrss, c.ru_maxrss)
+    rss *= 1 if _sys.platform == 'darwin' else 1024
+    return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime, rss
+
+
+_timings_path = _sys.argv.pop()
+with open(_sys.argv.pop(), 'r') as _f:
+    _cells = _json.load(_f)
+_timings = []
+
+# Cells are run in a separate namespace, so that they can't change the
+# variables used here
+_namespace = {'__name__': '__main__'}
+for _cell in _cells:
+    _t0, (_c0, _) = _time.perf_counter(), _usage()
+    exec(compile(_cell, '<string>', 'exec'), _namespace)
+    _t1, (_c1, _rss) = _time.perf_counter(), _usage()
+    _timings.append({'wall': _t1 - _t0, 'cpu': _c1 - _c0, 'peak_rss': _rss})
+    with open(_timings_path, 'w') as _f:
+        _json.dump(_timings, _f)
+'''
+
+# Absolute increases that are too small to count as performance regressions
+_timing_noise = {'wall': 0.5, 'cpu': 0.5, 'peak_rss': 16 * 2**20}
+
+
+def test_notebooks(links=False, jobs=1, timeout=None, changed_only=False,
+                   link_ttl=86400, offline=False, timings=None):
     """
     Tests all example notebooks.
 
     If ``links==True`` the notebook code will not be tested, but the notebook
     links will be tested instead.
+
+    Notebooks are tested in ``jobs`` parallel threads (each notebook is run in
+    its own subprocess). Results are shown as they come in, while the final
+    report is sorted by path. Notebooks that take longer than ``timeout``
+    seconds to run are stopped and count as failed.
+
+    If ``changed_only==True``, notebooks are skipped if they passed in a
+    previous run and neither their code nor any files they reference have
+    changed since (see :meth:`notebook_changed`). This does not affect link
+    checking.
+
+    Remote links are checked with a :class:`RemoteLinkChecker`, using the
+    arguments ``link_ttl`` and ``offline``.
+
+    If a dict ``timings`` is given, it will be filled with the performance
+    measurements for each notebook run (see :meth:`test_notebook`).
     """
     # Known errors, or directories to avoid
     ignore = [
@@ -47,10 +128,10 @@ def test_notebooks(links=False):
     if links:
         allowed_extensions.append('.md')
 
-    # Scan directory, running notebooks as we find them.
-    def scan(root, failed=None):
-        if failed is None:
-            failed = []
+    # Scan directory, gathering the files to test
+    def scan(root, found=None):
+        if found is None:
+            found = []
 
         for filename in sorted(os.listdir(root), key=natural_sort_key):
             if filename in ignore:
@@ -59,32 +140,74 @@ def test_notebooks(links=False):
 
             # Test notebooks
             if os.path.splitext(filename)[1] in allowed_extensions:
-                print('Testing ' + path + '.'*(max(0, 70 - len(path))), end='')
-                sys.stdout.flush()
-
-                if links:
-                    res = check_links(root, filename)
-                else:
-                    res = test_notebook(root, filename)
-                if res is None:
-                    print('ok')
-                else:
-                    if links:
-                        failed.append((path, res))
-                    else:
-                        failed.append((path, *res))
-                    print('FAIL')
+                found.append((root, filename))
 
             # Recurse into subdirectories
             elif os.path.isdir(path):
                 # Ignore hidden directories
                 if filename[:1] == '.':
                     continue
-                scan(path, failed)
+                scan(path, found)
 
-        return failed
+        return found
+
+    # Test a single file
+    def test(root, filename):
+        if links:
+            return check_links(root, filename, checker)
+        if changed_only and not notebook_changed(root, filename):
+            return 'skipped'
+        return test_notebook(root, filename, timeout, timings)
+
+    # Store the result for a single file, and return a status message
+    def record(path, res):
+        if res is None or res == 'skipped':
+            return res or 'ok'
+        if links:
+            failed.append((path, res))
+        else:
+            failed.append((path, *res))
+        return 'FAIL'
+
+    failed = []
+    found = scan('.')
+    if links:
+        checker = RemoteLinkChecker(link_ttl, offline)
+    if jobs == 1:
+        for root, filename in found:
+            path = os.path.join(root, filename)
+            print('Testing ' + path + '.' * (max(0, 70 - len(path))), end='')
+            sys.stdout.flush()
+            print(record(path, test(root, filename)))
+    else:
+        # Show results as they come in
+        print(f'Testing {len(found)} files in {jobs} parallel jobs')
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = {
+                pool.submit(test, root, filename):
+                os.path.join(root, filename) for root, filename in found}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    path = futures[future]
+                    res = record(path, future.result())
+                    print('Tested ' + path + '.' * (max(0, 71 - len(path)))
+                          + res)
+                    sys.stdout.flush()
+            except KeyboardInterrupt:
+                # Only the main thread receives the interrupt: cancel any
+                # notebooks that haven't started, and kill the running ones
+                for future in futures:
+                    future.cancel()
+                with _running_lock:
+                    for p in _running:
+                        _kill(p)
+                print()
+                print('Aborted by keyboard interrupt.')
+                return False
+        failed.sort(key=lambda x: natural_sort_key(x[0]))
+    if links:
+        checker.close()
 
-    failed = scan('.')
     if failed:
         if links:
             for path, msg in failed:
@@ -106,48 +229,209 @@ def test_notebooks(links=False):
     return True
 
 
-def test_notebook(root, path):
+def test_notebook(root, path, timeout=None, timings=None):
     """
     Tests a notebook in a subprocess; returns ``None`` if it passes or a tuple
     (stdout, stderr) if it fails.
+
+    If a ``timeout`` (in seconds) is given, the subprocess is killed if it
+    hasn't finished within that time, and the notebook counts as failed. The
+    notebook runs in a new process group, so that any processes it started
+    are killed too.
+
+    If a dict ``timings`` is given, an entry will be added for this notebook
+    with its wall time, CPU time (including any child processes) and peak
+    resident set size (in bytes), as a dict with keys ``wall``, ``cpu``,
+    ``peak_rss``, ``passed``, and ``cells``. The last entry contains a list
+    with the same measurements for every cell that was run, where the peak RSS
+    is the highest value reached since the notebook started.
     """
     # Load notebook, convert to python
-    e = nbconvert.exporters.PythonExporter()
-    code, _ = e.from_filename(os.path.join(root, path))
+    code = convert_notebook(os.path.join(root, path))
+    key = notebook_key(root, code)
 
     # Remove coding statement, if present
     code = '\n'.join([x for x in code.splitlines() if x[:9] != '# coding'])
 
+    # Split into cells, keeping any header with the first cell
+    cells = _cell_regex.split(code)
+    if len(cells) > 1:
+        cells[:2] = [cells[0] + cells[1]]
+
     # Tell matplotlib not to produce any figures
     env = os.environ.copy()
     env['MPLBACKEND'] = 'Template'
 
-    # Run in subprocess
-    cmd = [sys.executable, '-c', code]
-    curdir = os.getcwd()
-    try:
-        os.chdir(root)
+    with tempfile.TemporaryDirectory() as d:
+        cells_path = os.path.join(d, 'cells.json')
+        timings_path = os.path.join(d, 'timings.json')
+        with open(cells_path, 'w') as f:
+            json.dump(cells, f)
+
+        # Run in subprocess, from the notebook's directory
+        cmd = [sys.executable, '-c', _runner, cells_path, timings_path]
+        t0 = time.perf_counter()
         p = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+            cwd=root, start_new_session=(os.name == 'posix'),
         )
-        stdout, stderr = p.communicate()
-        # TODO: Use p.communicate(timeout=3600) if Python3 only
-        if p.returncode != 0:
-            # Show failing code, output and errors before returning
-            return (stdout.decode('utf-8'), stderr.decode('utf-8'))
-    except KeyboardInterrupt:
-        p.terminate()
-        return ('', 'Keyboard Interrupt')
-    finally:
-        os.chdir(curdir)
+        with _running_lock:
+            _running.add(p)
+        try:
+            try:
+                stdout, stderr = p.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                _kill(p)
+                try:
+                    stdout, stderr = p.communicate(timeout=5)
+                except subprocess.TimeoutExpired:
+                    stdout, stderr = b'', b''
+                return (
+                    stdout.decode('utf-8'),
+                    stderr.decode('utf-8')
+                    + f'\nTimeout after {timeout} seconds',
+                )
+            except KeyboardInterrupt:
+                _kill(p)
+                return ('', 'Keyboard Interrupt')
+        finally:
+            with _running_lock:
+                _running.discard(p)
+            # Store timings, including for failed runs
+            if timings is not None:
+                t = {'wall': time.perf_counter() - t0}
+                try:
+                    with open(timings_path, 'r') as f:
+                        t['cells'] = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    t['cells'] = []
+                t['cpu'] = sum([x['cpu'] for x in t['cells']])
+                t['peak_rss'] = max([x['peak_rss'] for x in t['cells']] or [0])
+                t['passed'] = p.returncode == 0
+                timings[os.path.normpath(os.path.join(root, path))] = t
+
+    if p.returncode != 0:
+        # Show failing code, output and errors before returning
+        store_result(os.path.join(root, path), None)
+        return (stdout.decode('utf-8'), stderr.decode('utf-8'))
+    store_result(os.path.join(root, path), key)
     return None
 
 
-def check_links(root, path):
+def _kill(p):
+    """
+    Kills a notebook subprocess ``p``, along with its process group on POSIX,
+    so that any processes it started (which may hold its output pipes) are
+    killed too.
+    """
+    try:
+        if os.name == 'posix':
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except ProcessLookupError:
+        pass
+
+
+def convert_notebook(path, markdown=False):
+    """
+    Converts the notebook at ``path`` to Python code (or to Markdown if
+    ``markdown=True``) and returns the result.
+
+    Converted notebooks are cached on disk, using a hash of the notebook's
+    contents, so that unchanged notebooks don't need to be converted again.
+    """
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    cached = os.path.join(_cache_dir, digest + ('.md' if markdown else '.py'))
+    try:
+        with open(cached, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    if markdown:
+        e = nbconvert.exporters.MarkdownExporter()
+    else:
+        e = nbconvert.exporters.PythonExporter()
+    code, _ = e.from_filename(path)
+
+    # Write to a temporary file first, in case another thread is writing too
+    os.makedirs(_cache_dir, exist_ok=True)
+    temp = f'{cached}.{os.getpid()}.{threading.get_ident()}'
+    with open(temp, 'w', encoding='utf-8') as f:
+        f.write(code)
+    os.replace(temp, cached)
+    return code
+
+
+def notebook_changed(root, path):
+    """
+    Returns ``False`` if the notebook at ``root/path`` passed its last test
+    run, and neither its code nor any files it references have changed since.
+    """
+    path = os.path.join(root, path)
+    key = notebook_key(root, convert_notebook(path))
+    return load_results().get(os.path.normpath(path)) != key
+
+
+def notebook_key(root, code):
+    """
+    Returns a hash of a notebook's ``code`` and of all files it references.
+
+    Referenced files (e.g. models in ``examples/models``, or data files) are
+    found by checking every string literal in the code for a path to an
+    existing file, relative to ``root``.
+    """
+    h = hashlib.sha256(code.encode('utf-8'))
+    for name in sorted(set(_string_regex.findall(code))):
+        path = os.path.join(root, name)
+        if os.path.isfile(path):
+            h.update(name.encode('utf-8'))
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def load_results():
+    """
+    Returns a dict mapping the paths of all notebooks that passed their last
+    test run to the :meth:`notebook_key` they had at the time.
+    """
+    try:
+        with open(os.path.join(_cache_dir, 'results.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def store_result(path, key):
+    """
+    Stores the result of testing the notebook at ``path``: its
+    :meth:`notebook_key` if it passed, or ``None`` if it failed.
+    """
+    path = os.path.normpath(path)
+    with _cache_lock:
+        results = load_results()
+        if key is None:
+            results.pop(path, None)
+        else:
+            results[path] = key
+        os.makedirs(_cache_dir, exist_ok=True)
+        temp = os.path.join(_cache_dir, 'results.json.tmp')
+        with open(temp, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        os.replace(temp, os.path.join(_cache_dir, 'results.json'))
+
+
+def check_links(root, path, checker=None):
     """
     Checks all (Markdown) links in a given notebook, and checks that they
     resolve. Returns ``None`` if succesfull, or an error message if one or more
     links are broken.
+
+    Remote links are checked using the given :class:`RemoteLinkChecker`. If
+    none is given, a new one is created.
     """
     # Non-local link roots to convert to local root
     convert = [
@@ -157,8 +441,7 @@ def check_links(root, path):
     # Load contents
     if os.path.splitext(path)[1].lower() == '.ipynb':
         # Convert notebook
-        e = nbconvert.exporters.MarkdownExporter()
-        code, _ = e.from_filename(os.path.join(root, path))
+        code = convert_notebook(os.path.join(root, path), markdown=True)
     else:
         # Load as plain text
         with open(os.path.join(root, path), 'r') as f:
@@ -175,33 +458,12 @@ def check_links(root, path):
         if not os.path.exists(href):
             return f'Unknown path: {href}'
 
-    # Method to check a remote link
-    def check_remote(href):
-        # Get cached response
-        try:
-            response = _checked_links[href]
-        except Exception:
-            response = None
-
-        # Make a HEAD request
-        if response is None:
-            try:
-                response = requests.head(href).status_code
-            except requests.exceptions.SSLError:
-                # Ignore SSL certificates that can't be retrieved
-                warnings.warn(f'SSLError when checking {href}')
-                response = 'ssl-error'
-            _checked_links[href] = response
-
-        if response not in [200, 301, 302, 'ssl-error']:
-            return f'HTTP {response}: {href}'
-
     # Convert markdown to html
     html = '<body>' + markdown.markdown(code) + '</body>'
     doc = lxml.etree.fromstring(html)
 
-    # Scan over links, create error message
-    errors = []
+    # Scan over links
+    hrefs = []
     for href in doc.xpath('//a//@href|//img//@src'):
 
         # Ignore figures inside notebook
@@ -217,13 +479,24 @@ def check_links(root, path):
                 if href[:1] != '/':
                     href = '/' + href
 
-        # Check link
-        if href[:7].lower() in ['http://', 'https:/']:
-            ok = check_remote(href)
+        hrefs.append(href)
+
+    # Check remote links, all at once
+    if checker is None:
+        checker = RemoteLinkChecker()
+    responses = checker.check(
+        [x for x in hrefs if x[:7].lower() in ['http://', 'https:/']])
+
+    # Check links, create error message
+    errors = []
+    for href in hrefs:
+        if href in responses:
+            if responses[href] not in _ok_responses:
+                errors.append(f'HTTP {responses[href]}: {href}')
         else:
             ok = check_local(href)
-        if ok is not None:
-            errors.append(ok)
+            if ok is not None:
+                errors.append(ok)
 
     # Join error messages and return
     if errors:
@@ -231,6 +504,168 @@ def check_links(root, path):
     return None
 
 
+def write_timings(timings, path):
+    """
+    Writes the ``timings`` gathered by :meth:`test_notebooks` to ``path``, as
+    JSON or, if the path ends in ``.csv``, as CSV.
+
+    In the CSV file, each row contains the measurements for a single cell, or
+    for a whole notebook if the ``cell`` field is empty.
+    """
+    if os.path.splitext(path)[1].lower() != '.csv':
+        with open(path, 'w') as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+        return
+
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['notebook', 'cell', 'wall', 'cpu', 'peak_rss', 'passed'])
+        for name in sorted(timings, key=natural_sort_key):
+            t = timings[name]
+            w.writerow([
+                name, '', t['wall'], t['cpu'], t['peak_rss'], t['passed']])
+            for i, c in enumerate(t['cells']):
+                w.writerow([name, i, c['wall'], c['cpu'], c['peak_rss'], ''])
+
+
+def compare_timings(timings, baseline, tolerance=0.25):
+    """
+    Compares the ``timings`` gathered by :meth:`test_notebooks` with an
+    earlier set of timings ``baseline`` (as stored by :meth:`write_timings` in
+    JSON format), and returns a list of messages describing any regressions.
+
+    A notebook or cell counts as a regression if its wall time, CPU time, or
+    peak RSS increased by more than a fraction ``tolerance`` (relative to the
+    baseline), and by more than a small absolute amount that is attributed to
+    noise. Cells are only compared if the number of cells is unchanged.
+    """
+    def check(name, new, old):
+        for key, noise in _timing_noise.items():
+            a, b = old[key], new[key]
+            if b - a > tolerance * a and b - a > noise:
+                r = f'+{100 * (b - a) / a:.0f}%' if a > 0 else 'new'
+                messages.append(f'{name} {key}: {a:.6g} -> {b:.6g} ({r})')
+
+    messages = []
+    for name in sorted(timings, key=natural_sort_key):
+        new, old = timings[name], baseline.get(name)
+        if old is None or not (new['passed'] and old['passed']):
+            continue
+        check(name, new, old)
+        if len(new['cells']) == len(old['cells']):
+            for i, (x, y) in enumerate(zip(new['cells'], old['cells'])):
+                check(f'{name} [cell {i}]', x, y)
+    return messages
+
+
+class RemoteLinkChecker:
+    """
+    Checks remote links concurrently, using HEAD requests made through a
+    single pooled (keep-alive) session. At most ``per_host`` requests are made
+    to the same host at any one time, with at most ``workers`` in total.
+
+    Responses are stored in a persistent cache (in ``.test-cache/links.json``),
+    and re-used for ``ttl`` seconds. Failed checks are always repeated.
+
+    In ``offline`` mode no requests are made: responses are taken from the
+    cache regardless of their age, so that links can be checked without a
+    network connection. Links that are not in the cache are reported as
+    ``not-recorded``.
+    """
+    def __init__(self, ttl=86400, offline=False, workers=16, per_host=4,
+                 timeout=30):
+        self._ttl = ttl
+        self._offline = offline
+        self._timeout = timeout
+        self._per_host = per_host
+
+        # Cached responses, as href: (response, time)
+        self._path = os.path.join(_cache_dir, 'links.json')
+        try:
+            with open(self._path, 'r') as f:
+                self._cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._cache = {}
+
+        # Checks in progress or finished, as href: future
+        self._futures = {}
+
+        # Semaphores to limit the requests per host
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=per_host)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def check(self, hrefs):
+        """
+        Checks the given links, and returns a dict mapping each link to an HTTP
+        status code or error string. Links are never checked twice.
+        """
+        futures = {}
+        with self._lock:
+            for href in hrefs:
+                if href not in self._futures:
+                    self._futures[href] = self._pool.submit(self._check, href)
+                futures[href] = self._futures[href]
+        return {href: f.result() for href, f in futures.items()}
+
+    def _check(self, href):
+        """
+        Checks a single link.
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(href)
+        if cached is not None:
+            response, when = cached
+            if self._offline:
+                return response
+            if response in _ok_responses and now - when < self._ttl:
+                return response
+        if self._offline:
+            return 'not-recorded'
+
+        # Make a HEAD request
+        host = urllib.parse.urlsplit(href).netloc
+        with self._lock:
+            limit = self._hosts.setdefault(
+                host, threading.Semaphore(self._per_host))
+        with limit:
+            try:
+                response = self._session.head(
+                    href, timeout=self._timeout).status_code
+            except requests.exceptions.SSLError:
+                # Ignore SSL certificates that can't be retrieved
+                warnings.warn(f'SSLError when checking {href}')
+                response = 'ssl-error'
+            except requests.exceptions.RequestException as e:
+                response = type(e).__name__
+
+        with self._lock:
+            self._cache[href] = (response, now)
+        return response
+
+    def close(self):
+        """
+        Stops the worker threads, and writes the cache to disk.
+        """
+        self._pool.shutdown()
+        self._session.close()
+        if self._offline:
+            return
+        with self._lock:
+            os.makedirs(_cache_dir, exist_ok=True)
+            temp = self._path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self._cache, f, indent=1, sort_keys=True)
+            os.replace(temp, self._path)
+
+
 def natural_sort_key(s):
     """
     Function to use as ``key`` in a sort, to get natural sorting of strings
@@ -248,7 +683,42 @@ def natural_sort_key(s):
 
 
 if __name__ == '__main__':
-    links = 'links' in sys.argv
+    parser = argparse.ArgumentParser(description='Tests all notebooks.')
+    parser.add_argument(
+        'mode', nargs='?', choices=['links'],
+        help='Use "links" to check the links instead of running notebooks.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='The number of notebooks to test in parallel.')
+    parser.add_argument(
+        '--timeout', type=float, default=3600,
+        help='The maximum time (in seconds) to run a single notebook for.')
+    parser.add_argument(
+        '--changed-only', action='store_true',
+        help='Only run notebooks that have changed since they last passed.')
+    parser.add_argument(
+        '--link-ttl', type=float, default=86400,
+        help='The time (in seconds) to trust a previous remote link check.')
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='Check remote links using only previously recorded responses.')
+    parser.add_argument(
+        '--timings', metavar='PATH',
+        help='Write the time and memory used per notebook and per cell to a'
+             ' JSON file (or CSV if the path ends in .csv).')
+    parser.add_argument(
+        '--compare', metavar='BASELINE',
+        help='Compare time and memory use with a JSON file written earlier'
+             ' with --timings, and fail if there are regressions.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='The relative increase in time or memory that counts as a'
+             ' regression when using --compare.')
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('The number of jobs must be at least 1.')
+
+    links = args.mode == 'links'
     if links:
         print('Checking links in all notebooks')
     else:
@@ -258,5 +728,23 @@ if __name__ == '__main__':
     print()
     print('  Press Ctrl+C to abort.')
     print()
-    if not test_notebooks(links):
+    timings = {}
+    passed = test_notebooks(links, args.jobs, args.timeout, args.changed_only,
+                            args.link_ttl, args.offline, timings)
+    if args.timings:
+        write_timings(timings, args.timings)
+        print(f'Timings written to {args.timings}')
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_timings(timings, baseline, args.tolerance)
+        print('-' * 79)
+        if regressions:
+            print(f'Performance regressions ({len(regressions)}):')
+            for message in regressions:
+                print('  ' + message)
+            passed = False
+        else:
+            print('No performance regressions found.')
+    if not passed:
         sys.exit(1)